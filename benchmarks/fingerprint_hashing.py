@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+"""Compare throughput and allocations of the canonical fingerprint encoder with hashing json.dumps(sort_keys=True).
+
+    python3 -m benchmarks.fingerprint_hashing --records 2000
+"""
+import hashlib
+import json
+import random
+import time
+import tracemalloc
+from typing import Callable, List
+
+import click
+
+import benchmarks.fixtures as fixtures
+import external.fingerprint as fingerprint
+from external.subprocesses import group_testssl_findings
+
+
+def dumps_sslyze(scan_result: dict):
+    """The fingerprint as it was computed before: delete the volatile fields in place and hash the whole dump"""
+    for test_result in scan_result.values():
+        result = test_result.get('result')
+        if result is not None:
+            for accepted_cipher_suite in result.get('accepted_cipher_suites') or []:
+                del accepted_cipher_suite['ephemeral_key']
+                del accepted_cipher_suite['cipher_suite']['openssl_name']
+            for rejected_cipher_suite in result.get('rejected_cipher_suites') or []:
+                del rejected_cipher_suite['error_message']
+                del rejected_cipher_suite['cipher_suite']['openssl_name']
+    fp = json.dumps(scan_result, sort_keys=True)
+    return hashlib.sha256(fp.encode()).hexdigest(), fp
+
+
+def canonical_sslyze(scan_result: dict):
+    scan_result = fingerprint.project_sslyze(scan_result)
+    return fingerprint.canonical_fingerprint(scan_result, fingerprint.sslyze_section,
+                                             {'protocols': fingerprint.sslyze_protocols(scan_result)})
+
+
+def dumps_testssl(r: dict):
+    fp = json.dumps(r, sort_keys=True)
+    return hashlib.sha256(fp.encode()).hexdigest(), fp
+
+
+def section_hashes(obj: dict, section: Callable[[str], str]) -> dict:
+    """Per-section hashes by dumping every section on its own"""
+    sections = {name: dict() for name in fingerprint.SECTIONS}
+    for key, value in obj.items():
+        sections[section(key)][key] = value
+    return {name: hashlib.sha256(json.dumps(s, sort_keys=True).encode()).hexdigest() for name, s in sections.items()}
+
+
+def dumps_sections_sslyze(scan_result: dict):
+    fp_hash, fp = dumps_sslyze(scan_result)
+    sections = section_hashes({**scan_result, **fingerprint.sslyze_protocols(scan_result)}, fingerprint.sslyze_section)
+    return fp_hash, fp, sections
+
+
+def dumps_sections_testssl(r: dict):
+    return (*dumps_testssl(r), section_hashes(r, fingerprint.testssl_section))
+
+
+def canonical_testssl(r: dict):
+    return fingerprint.canonical_fingerprint(r, fingerprint.testssl_section)
+
+
+# dumps is the fingerprint without section hashes, dumps+sec adds them by dumping each section again
+ENCODERS = {
+    'sslyze': {'dumps': dumps_sslyze, 'dumps+sec': dumps_sections_sslyze, 'canonical': canonical_sslyze},
+    'testssl': {'dumps': dumps_testssl, 'dumps+sec': dumps_sections_testssl, 'canonical': canonical_testssl},
+}
+
+
+def records(tool: str, count: int, seed: int) -> List[str]:
+    """Serialized records so that every run decodes fresh objects, dumps_sslyze modifies its input"""
+    rng = random.Random(seed)
+    if tool == 'sslyze':
+        return [json.dumps(fixtures.sslyze_server_scan_result(i, rng)['scan_result']) for i in range(count)]
+    findings = (f for i in range(count) for f in fixtures.testssl_findings(i, rng))
+    return [json.dumps(r) for _, r in group_testssl_findings(findings, None)]
+
+
+def measure_time(encoder: Callable, serialized: List[str], repeat: int) -> float:
+    best = float('inf')
+    for _ in range(repeat):
+        objects = [json.loads(s) for s in serialized]
+        start = time.perf_counter()
+        for o in objects:
+            encoder(o)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def measure_allocations(encoder: Callable, serialized: List[str]):
+    """Peak and total size of the memory allocated while encoding a record, averaged over the records"""
+    objects = [json.loads(s) for s in serialized]
+    peak = 0
+    allocated = 0
+    tracemalloc.start()
+    try:
+        for o in objects:
+            tracemalloc.reset_peak()
+            before = tracemalloc.get_traced_memory()[0]
+            result = encoder(o)
+            current, record_peak = tracemalloc.get_traced_memory()
+            peak += record_peak - before
+            allocated += current - before
+            del result
+    finally:
+        tracemalloc.stop()
+    return peak / len(objects), allocated / len(objects)
+
+
+@click.command()
+@click.option('--records', 'count', type=int, default=2000)
+@click.option('--repeat', type=int, default=5)
+@click.option('--seed', type=int, default=0)
+@click.option('--tool', type=click.Choice(list(ENCODERS)), multiple=True, default=list(ENCODERS))
+def main(count: int, repeat: int, seed: int, tool):
+    click.echo(f'{"tool":<8} {"encoder":<10} {"records/s":>10} {"MB/s":>8} {"peak [KiB]":>11} {"kept [KiB]":>11}')
+    for t in tool:
+        serialized = records(t, count, seed)
+        raw_bytes = sum(len(ENCODERS[t]['canonical'](json.loads(s))[1]) for s in serialized)
+        for name, encoder in ENCODERS[t].items():
+            duration = measure_time(encoder, serialized, repeat)
+            peak, kept = measure_allocations(encoder, serialized)
+            click.echo(f'{t:<8} {name:<10} {len(serialized) / duration:>10.0f} {raw_bytes / duration / 1e6:>8.1f} '
+                       f'{peak / 1024:>11.1f} {kept / 1024:>11.1f}')
+
+
+if __name__ == '__main__':
+    main()
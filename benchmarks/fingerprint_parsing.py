@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+"""Compare peak RSS and runtime of the streaming and the in-memory fingerprint generation.
+
+    python3 -m benchmarks.fingerprint_parsing --work-dir ./bench-tmp --size-gb 2
+"""
+import os
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+import click
+
+import benchmarks.fixtures as fixtures
+
+TOOLS = {
+    'sslyze': ('sslyze.json', fixtures.write_sslyze_json),
+    'testssl': ('testssl.json', fixtures.write_testssl_json),
+}
+
+
+@click.group(invoke_without_command=True)
+@click.option('--work-dir', type=click.Path(file_okay=False), default='./bench-tmp')
+@click.option('--size-gb', type=float, default=2.0)
+@click.option('--tool', type=click.Choice(list(TOOLS)), multiple=True, default=list(TOOLS))
+@click.pass_context
+def main(ctx, work_dir: str, size_gb: float, tool):
+    if ctx.invoked_subcommand is not None:
+        return
+    click.echo(f'{"tool":<8} {"mode":<10} {"targets":>10} {"runtime [s]":>12} {"peak RSS [MiB]":>15}')
+    for t in tool:
+        tool_dir = os.path.join(work_dir, t)
+        targets = prepare_input(t, tool_dir, int(size_gb * (1 << 30)))
+        for streaming in [True, False]:
+            runtime, max_rss = measure(t, tool_dir, streaming)
+            mode = 'streaming' if streaming else 'in-memory'
+            click.echo(f'{t:<8} {mode:<10} {targets:>10} {runtime:>12.1f} {max_rss / 1024:>15.1f}')
+
+
+@main.command(hidden=True)
+@click.argument('tool')
+@click.argument('tool_dir')
+@click.argument('streaming', type=bool)
+def run_one(tool: str, tool_dir: str, streaming: bool):
+    import external.subprocesses as subprocesses
+    if tool == 'sslyze':
+        subprocesses.generate_sslyze_fingerprints(tool_dir, streaming=streaming)
+    else:
+        subprocesses.generate_testssl_fingerprints(tool_dir, streaming=streaming)
+
+
+def prepare_input(tool: str, tool_dir: str, size_bytes: int) -> int:
+    """Generate the synthetic input once, the number of targets is cached next to it"""
+    file_name, writer = TOOLS[tool]
+    Path(tool_dir).mkdir(parents=True, exist_ok=True)
+    input_file = Path(tool_dir, file_name)
+    meta_file = Path(tool_dir, f'{file_name}.{size_bytes}.targets')
+    if not input_file.exists() or not meta_file.exists():
+        with input_file.open(mode='w') as f:
+            targets = writer(f, size_bytes)
+        meta_file.write_text(str(targets))
+    return int(meta_file.read_text())
+
+
+def measure(tool: str, tool_dir: str, streaming: bool):
+    """Run one generation in a fresh interpreter so its peak RSS (in KiB) is not shared with other runs"""
+    start = time.monotonic()
+    p = subprocess.Popen([sys.executable, '-m', 'benchmarks.fingerprint_parsing', 'run-one', tool, tool_dir,
+                          str(streaming)])
+    _, status, rusage = os.wait4(p.pid, 0)
+    p.returncode = os.waitstatus_to_exitcode(status)
+    runtime = time.monotonic() - start
+    if p.returncode != 0:
+        raise click.ClickException(f'{tool} (streaming={streaming}) failed with exit code {p.returncode}')
+    return runtime, rusage.ru_maxrss
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,116 @@
+import json
+import os
+import random
+from typing import TextIO
+
+CIPHER_SUITES = [
+    ('TLS_ECDHE_RSA_WITH_AES_256_GCM_SHA384', 'ECDHE-RSA-AES256-GCM-SHA384', 256),
+    ('TLS_ECDHE_RSA_WITH_AES_256_CBC_SHA384', 'ECDHE-RSA-AES256-SHA384', 256),
+    ('TLS_ECDHE_RSA_WITH_CHACHA20_POLY1305_SHA256', 'ECDHE-RSA-CHACHA20-POLY1305', 256),
+    ('TLS_ECDHE_RSA_WITH_AES_256_CBC_SHA', 'ECDHE-RSA-AES256-SHA', 256),
+    ('TLS_RSA_WITH_AES_256_GCM_SHA384', 'AES256-GCM-SHA384', 256),
+    ('TLS_RSA_WITH_AES_256_CBC_SHA256', 'AES256-SHA256', 256),
+    ('TLS_RSA_WITH_AES_256_CBC_SHA', 'AES256-SHA', 256),
+    ('TLS_RSA_WITH_3DES_EDE_CBC_SHA', 'DES-CBC3-SHA', 168),
+]
+SSLYZE_VERSIONS = ['ssl_2_0', 'ssl_3_0', 'tls_1_0', 'tls_1_1', 'tls_1_2', 'tls_1_3']
+TESTSSL_IDS = ['SSLv2', 'SSLv3', 'TLS1', 'TLS1_1', 'TLS1_2', 'TLS1_3', 'NPN', 'ALPN', 'cipherlist_NULL',
+               'cipherlist_aNULL', 'cipherlist_EXPORT', 'cipher_order', 'TLS_extensions', 'TLS_session_ticket',
+               'SSL_sessionID_support', 'sessionresumption_ticket', 'HSTS', 'HPKP', 'banner_server', 'heartbleed',
+               'CCS', 'ticketbleed', 'ROBOT', 'secure_renego', 'secure_client_renego', 'CRIME_TLS', 'POODLE_SSL',
+               'fallback_SCSV', 'SWEET32', 'FREAK', 'DROWN', 'LOGJAM', 'BEAST', 'LUCKY13', 'RC4',
+               'scanTime', 'cert_serialNumber', 'DNS_CAArecord', 'OCSP_stapling', 'clientsimulation-android_442']
+
+
+def _ip(i: int) -> str:
+    return f'10.{(i >> 16) & 0xff}.{(i >> 8) & 0xff}.{i & 0xff}'
+
+
+def _cipher_suite(suite) -> dict:
+    name, openssl_name, key_size = suite
+    return {'name': name, 'openssl_name': openssl_name, 'is_anonymous': False, 'key_size': key_size}
+
+
+def sslyze_server_scan_result(i: int, rng: random.Random) -> dict:
+    """One entry of "server_scan_results" shaped like the output of the sslyze version we run"""
+    scan_result = dict()
+    for version in SSLYZE_VERSIONS:
+        accepted = []
+        rejected = []
+        for suite in CIPHER_SUITES:
+            if version in ['tls_1_0', 'tls_1_1', 'tls_1_2'] and rng.random() < 0.6:
+                accepted.append({
+                    'cipher_suite': _cipher_suite(suite),
+                    'ephemeral_key': {'type_name': 'ECDH', 'size': 256, 'curve_name': 'prime256v1',
+                                      'public_bytes': ''.join(rng.choices('0123456789abcdef', k=130))},
+                })
+            else:
+                rejected.append({
+                    'cipher_suite': _cipher_suite(suite),
+                    'error_message': f'TLS alert: handshake failure ({rng.randint(0, 1 << 30)})',
+                })
+        scan_result[f'{version}_cipher_suites'] = {
+            'status': 'COMPLETED',
+            'result': {
+                'tls_version_used': version.upper(),
+                'is_tls_version_supported': len(accepted) > 0,
+                'accepted_cipher_suites': accepted,
+                'rejected_cipher_suites': rejected,
+            },
+        }
+    scan_result['elliptic_curves'] = {'status': 'COMPLETED', 'result': {
+        'supports_ecdh_key_exchange': True,
+        'supported_curves': [{'name': 'prime256v1', 'openssl_nid': 415}, {'name': 'X25519', 'openssl_nid': 1034}],
+        'rejected_curves': [{'name': 'sect163k1', 'openssl_nid': 721}]}}
+    scan_result['tls_compression'] = {'status': 'COMPLETED', 'result': {'supports_compression': False}}
+    scan_result['tls_fallback_scsv'] = {'status': 'COMPLETED', 'result': {'supports_fallback_scsv': True}}
+    return {
+        'server_location': {'hostname': f'host{i}.example.com', 'ip_address': _ip(i), 'port': 443,
+                            'connection_type': 'DIRECT'},
+        'network_configuration': {'tls_server_name_indication': f'host{i}.example.com'},
+        'scan_status': 'COMPLETED',
+        'scan_result': scan_result,
+    }
+
+
+def testssl_findings(i: int, rng: random.Random) -> list:
+    """The flat --jsonfile findings testssl.sh writes for one target"""
+    target = f'host{i}.example.com/{_ip(i)}'
+    return [{'id': id, 'ip': target, 'port': '443', 'severity': rng.choice(['OK', 'INFO', 'LOW', 'HIGH']),
+             'finding': rng.choice(['offered', 'not offered', 'not vulnerable', f'value {rng.randint(0, 9)}'])}
+            for id in TESTSSL_IDS]
+
+
+def write_sslyze_json(f: TextIO, size_bytes: int, seed: int = 0) -> int:
+    """Write an sslyze.json of roughly size_bytes and return the number of server scan results"""
+    rng = random.Random(seed)
+    f.write('{"date_scans_started": "2023-01-01T00:00:00", "sslyze_version": "5.0.0", "server_scan_results": [')
+    written = 0
+    i = 0
+    while written < size_bytes:
+        if i > 0:
+            f.write(', ')
+        entry = json.dumps(sslyze_server_scan_result(i, rng))
+        written += len(entry)
+        f.write(entry)
+        i += 1
+    f.write('], "invalid_server_strings": []}')
+    return i
+
+
+def write_testssl_json(f: TextIO, size_bytes: int, seed: int = 0) -> int:
+    """Write a testssl.json of roughly size_bytes and return the number of targets"""
+    rng = random.Random(seed)
+    f.write('[' + os.linesep)
+    written = 0
+    i = 0
+    while written < size_bytes:
+        for j, finding in enumerate(testssl_findings(i, rng)):
+            if i > 0 or j > 0:
+                f.write(',' + os.linesep)
+            entry = json.dumps(finding, indent=10)
+            written += len(entry)
+            f.write(entry)
+        i += 1
+    f.write(os.linesep + ']' + os.linesep)
+    return i
@@ -0,0 +1,279 @@
+#!/usr/bin/env python3
+"""Throughput and latency of the stages of a local scan, offline and without Docker.
+
+    python3 -m benchmarks.pipeline --work-dir ./bench-tmp
+    python3 -m benchmarks.pipeline --work-dir ./bench-tmp --update-baseline
+
+The webserver containers are replaced by the stand-in servers of benchmarks.standin and the scanners and tcpdump by
+benchmarks.stub_scanner, so the numbers measure the pipeline around the scanners, not the scanners. The results
+are compared with the baseline file, a metric that is worse by more than the tolerance is a regression.
+--update-baseline writes the results of this machine as the new baseline instead.
+"""
+import json
+import os
+import platform
+import shutil
+import statistics
+import stat
+import sys
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import Callable, Dict, List, Tuple
+
+import click
+
+import benchmarks.fixtures as fixtures
+import external.subprocesses as subprocesses
+import main as dissectls
+import pipeline.telemetry as telemetry
+from benchmarks.standin import StandInServers, handshake
+from benchmarks.stub_scanner import HANDSHAKES_ENV, PACKETS_ENV
+from tls_configs.test_case import create_test_cases
+from tls_configs.tls_config import ConfigSpace
+
+BASELINE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline.json')
+START_PORT = 20000
+STUB_TOOLS = ['goscanner', 'testssl', 'sslyze', 'tcpdump']
+
+# name -> (value, unit, whether higher is better)
+Metrics = Dict[str, Tuple[float, str, bool]]
+
+
+def throughput(count: int, seconds: float) -> float:
+    return count / seconds if seconds > 0 else float('inf')
+
+
+def bench_plan(work_dir: str, chunk_size: int, **_) -> Metrics:
+    """ConfigSpace and plan_test_case over all test cases"""
+    scanned = dict()
+    configs = 0
+    latencies = []
+    for test_case in create_test_cases(os.path.join(work_dir, 'plan')):
+        start = time.perf_counter()
+        space = ConfigSpace(test_case)
+        indices = dissectls.plan_test_case(test_case, space, chunk_size, scanned, True)
+        # Build the configs of every chunk like local-scan
+        chunks = [[space[k] for k in chunk_indices] for chunk_indices in dissectls.chunker(indices, chunk_size)]
+        assert sum(len(chunk) for chunk in chunks) == len(indices)
+        latencies.append(time.perf_counter() - start)
+        configs += len(space)
+    return {'configs/s': (throughput(configs, sum(latencies)), 'configs/s', True),
+            'test case max': (max(latencies), 's', False)}
+
+
+def bench_render(work_dir: str, **_) -> Metrics:
+    """Rendering the nginx and Apache configs of all test cases"""
+    configs = [c for test_case in create_test_cases(work_dir) for c in ConfigSpace(test_case)]
+    metrics = OrderedDict()
+    for webserver in dissectls.WEBSERVERS:
+        start = time.perf_counter()
+        for config in configs:
+            dissectls.render_webserver_config(webserver, config)
+        metrics[f'{webserver} configs/s'] = (throughput(len(configs), time.perf_counter() - start), 'configs/s', True)
+    return metrics
+
+
+def _chunk_configs(chunk_size: int) -> list:
+    """The first chunk_size configs of all test cases, a mix of protocols and ciphers"""
+    configs = [c for test_case in create_test_cases('') for c in ConfigSpace(test_case)]
+    return configs[:chunk_size]
+
+
+def bench_servers(chunk_size: int, **_) -> Metrics:
+    """Starting and stopping the servers of a chunk, and TLS handshakes with them"""
+    servers = StandInServers(_chunk_configs(chunk_size), START_PORT)
+    start = time.perf_counter()
+    ports = servers.start()
+    started = time.perf_counter() - start
+    try:
+        latencies = []
+        failed = 0
+        handshakes_start = time.perf_counter()
+        for port in ports:
+            ok, latency = handshake(port)
+            latencies.append(latency)
+            failed += not ok
+        handshakes = time.perf_counter() - handshakes_start
+    finally:
+        start = time.perf_counter()
+        servers.stop()
+        stopped = time.perf_counter() - start
+    if failed > 0:
+        click.echo(f'{failed} of {len(ports)} handshakes failed', err=True)
+    return {'chunk start': (started, 's', False), 'chunk stop': (stopped, 's', False),
+            'handshakes/s': (throughput(len(ports), handshakes), 'handshakes/s', True),
+            'handshake p50': (statistics.median(latencies) * 1000, 'ms', False),
+            'handshake max': (max(latencies) * 1000, 'ms', False)}
+
+
+def bench_scan(work_dir: str, chunk_size: int, max_parallel_phases: int, **_) -> Metrics:
+    """do_docker_scan of one chunk with the stub scanners against the stand-in servers, per phase from the trace"""
+    bin_dir = os.path.join(work_dir, 'bin')
+    output_dir = os.path.join(work_dir, 'scan')
+    shutil.rmtree(output_dir, ignore_errors=True)
+    run = telemetry.start(output_dir)
+    with StandInServers(_chunk_configs(chunk_size), START_PORT) as ports:
+        start = time.perf_counter()
+        try:
+            dissectls.do_docker_scan(0, ports, output_dir, None, os.path.join(bin_dir, 'goscanner'),
+                                     os.path.join(bin_dir, 'testssl'), False, max_parallel_phases)
+        finally:
+            os.environ.pop(telemetry.TRACE_ENV)
+        wall = time.perf_counter() - start
+    metrics = OrderedDict([('chunk', (wall, 's', False)),
+                           ('targets/s', (throughput(len(ports), wall), 'targets/s', True))])
+    for record in telemetry.read_trace(output_dir, run):
+        if record['status'] != 'ok':
+            raise click.ClickException(f'Phase {record["phase"]} failed with {record["status"]}')
+        metrics[f'{record["phase"]}'] = (record['wall'], 's', False)
+    return metrics
+
+
+def bench_capture(work_dir: str, chunk_size: int, packets: int, **_) -> Metrics:
+    """CaptureClientHellos reading the Client Hellos that the stub tcpdump prints"""
+    os.environ[PACKETS_ENV] = str(packets)
+    ports = [START_PORT + i for i in range(chunk_size)]
+    chs_file = os.path.join(work_dir, 'capture_chs.csv')
+    Path(chs_file).unlink(missing_ok=True)
+    capture = dissectls.CaptureClientHellos(True, ports, chs_file)
+    start = time.perf_counter()
+    with capture:
+        pass
+    wall = time.perf_counter() - start
+    captured = sum(int(line.split(',')[0]) for line in Path(chs_file).read_text().splitlines())
+    if captured != packets:
+        raise click.ClickException(f'Counted {captured} of {packets} Client Hellos')
+    # stop() waits for a quiet period after the last packet, which is part of the latency of every phase
+    return {'capture': (wall, 's', False), 'packets/s': (throughput(packets, wall), 'packets/s', True)}
+
+
+def bench_fingerprints(work_dir: str, fixture_mb: float, **_) -> Metrics:
+    """Streaming fingerprint generation of large sslyze and testssl.sh outputs"""
+    metrics = OrderedDict()
+    size_bytes = int(fixture_mb * (1 << 20))
+    for tool, (file_name, writer), generate in [
+            ('sslyze', ('sslyze.json', fixtures.write_sslyze_json), subprocesses.generate_sslyze_fingerprints),
+            ('testssl', ('testssl.json', fixtures.write_testssl_json), subprocesses.generate_testssl_fingerprints)]:
+        # The fixtures are generated once per size and reused by later runs
+        tool_dir = Path(work_dir, 'fingerprints', tool, str(size_bytes))
+        tool_dir.mkdir(parents=True, exist_ok=True)
+        done_file = Path(tool_dir, f'{file_name}.done')
+        if not done_file.exists():
+            with Path(tool_dir, file_name).open(mode='w') as f:
+                writer(f, size_bytes)
+            done_file.touch()
+        start = time.perf_counter()
+        targets = generate(str(tool_dir))
+        wall = time.perf_counter() - start
+        metrics[f'{tool} MB/s'] = (Path(tool_dir, file_name).stat().st_size / wall / 1e6, 'MB/s', True)
+        metrics[f'{tool} targets/s'] = (throughput(targets, wall), 'targets/s', True)
+    return metrics
+
+
+STAGES: Dict[str, Callable[..., Metrics]] = OrderedDict([
+    ('plan', bench_plan),
+    ('render', bench_render),
+    ('servers', bench_servers),
+    ('scan', bench_scan),
+    ('capture', bench_capture),
+    ('fingerprints', bench_fingerprints),
+])
+
+
+def install_stubs(work_dir: str, handshakes: int):
+    """Executables for the stub scanners in work_dir/bin, on the PATH for tcpdump and used for SSLyze"""
+    bin_dir = Path(work_dir, 'bin').absolute()
+    bin_dir.mkdir(parents=True, exist_ok=True)
+    root = Path(__file__).parent.parent.absolute()
+    for tool in STUB_TOOLS:
+        path = Path(bin_dir, tool)
+        path.write_text(f'#!/bin/sh\nPYTHONPATH="{root}${{PYTHONPATH:+:$PYTHONPATH}}" '
+                        f'exec "{sys.executable}" -m benchmarks.stub_scanner {tool} "$@"\n')
+        path.chmod(path.stat().st_mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
+    os.environ['PATH'] = f'{bin_dir}{os.pathsep}{os.environ.get("PATH", "")}'
+    os.environ[subprocesses.SSLYZE_ENV] = str(Path(bin_dir, 'sslyze'))
+    os.environ[HANDSHAKES_ENV] = str(handshakes)
+
+
+def best(runs: List[Metrics]) -> Metrics:
+    """Best value of every metric over the repetitions, the least disturbed run"""
+    result = OrderedDict()
+    for name, (_, unit, higher) in runs[0].items():
+        values = [r[name][0] for r in runs if name in r]
+        result[name] = (max(values) if higher else min(values), unit, higher)
+    return result
+
+
+def environment(options: dict) -> dict:
+    return {'python': platform.python_version(), 'machine': platform.machine(), 'cpus': os.cpu_count(),
+            'options': options}
+
+
+def compare(results: Dict[str, Metrics], baseline: dict, tolerance: float) -> List[str]:
+    """Print the results next to the baseline and return the regressed metrics"""
+    regressions = []
+    click.echo(f'{"stage":<13} {"metric":<28} {"value":>12} {"baseline":>12} {"change":>8}')
+    for stage, metrics in results.items():
+        for name, (value, unit, higher) in metrics.items():
+            key = f'{stage}.{name}'
+            reference = baseline.get('metrics', dict()).get(key)
+            change = ''
+            flag = ''
+            if reference is not None and reference > 0:
+                relative = value / reference - 1
+                change = f'{relative:+.0%}'
+                if (relative < -tolerance) if higher else (relative > tolerance):
+                    flag = ' REGRESSION'
+                    regressions.append(key)
+            reference = f'{reference:>12.3f}' if reference is not None else f'{"-":>12}'
+            click.echo(f'{stage:<13} {f"{name} [{unit}]":<28} {value:>12.3f} {reference} {change:>8}{flag}')
+    return regressions
+
+
+@click.command()
+@click.option('--work-dir', type=click.Path(file_okay=False), default='./bench-tmp')
+@click.option('--stage', type=click.Choice(list(STAGES)), multiple=True, default=list(STAGES))
+@click.option('--repeat', type=int, default=3)
+@click.option('--chunk-size', type=int, default=100, help='Configs and stand-in servers per chunk')
+@click.option('--max-parallel-phases', type=int, default=1)
+@click.option('--handshakes', type=int, default=1, help='Handshakes of the stub scanners per target')
+@click.option('--packets', type=int, default=100000, help='Client Hellos printed by the stub tcpdump')
+@click.option('--fixture-mb', type=float, default=64, help='Size of the sslyze and testssl.sh fixtures')
+@click.option('--baseline', 'baseline_file', type=click.Path(dir_okay=False), default=BASELINE_FILE)
+@click.option('--tolerance', type=float, default=0.2, help='Relative change of a metric that is a regression')
+@click.option('--update-baseline', is_flag=True, help='Write the results as the new baseline')
+def main(work_dir: str, stage, repeat: int, chunk_size: int, max_parallel_phases: int, handshakes: int,
+         packets: int, fixture_mb: float, baseline_file: str, tolerance: float, update_baseline: bool):
+    Path(work_dir).mkdir(parents=True, exist_ok=True)
+    work_dir = os.path.abspath(work_dir)
+    install_stubs(work_dir, handshakes)
+    options = {'chunk_size': chunk_size, 'max_parallel_phases': max_parallel_phases, 'handshakes': handshakes,
+               'packets': packets, 'fixture_mb': fixture_mb}
+    results = OrderedDict()
+    for name in stage:
+        results[name] = best([STAGES[name](work_dir=work_dir, **options) for _ in range(repeat)])
+
+    baseline = dict()
+    if Path(baseline_file).exists():
+        baseline = json.loads(Path(baseline_file).read_text())
+        if baseline.get('environment') != environment(options):
+            click.echo(f'The baseline was measured in another environment: {baseline.get("environment")}', err=True)
+    regressions = compare(results, baseline, tolerance)
+
+    if update_baseline:
+        metrics = {f'{s}.{name}': value for s, m in results.items() for name, (value, _, _) in m.items()}
+        # Keep the metrics of the stages that did not run
+        metrics = {**baseline.get('metrics', dict()), **metrics}
+        Path(baseline_file).write_text(json.dumps({'environment': environment(options), 'metrics': metrics},
+                                                  indent=2, sort_keys=True) + os.linesep)
+        click.echo(f'Wrote the baseline to {baseline_file}')
+    elif len(baseline) == 0:
+        click.echo(f'No baseline in {baseline_file}, create it with --update-baseline')
+    elif len(regressions) > 0:
+        raise click.ClickException(f'{len(regressions)} metrics regressed by more than {tolerance:.0%}: '
+                                   f'{", ".join(regressions)}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,126 @@
+"""In-process TLS servers standing in for the webserver containers, configured from a TLSConfig.
+
+Python's ssl module covers protocols, ciphers, server preference, session tickets, and ALPN of a TLSConfig. OCSP
+stapling cannot be configured, so ssl_stapling is ignored.
+"""
+import socket
+import socketserver
+import ssl
+import threading
+import time
+from typing import List, Tuple
+
+from tls_configs.tls_config import TLSConfig
+
+CERT_FILE = 'certificates/cert.pem'
+KEY_FILE = 'certificates/key.pem'
+
+PROTOCOL_VERSIONS = {
+    'SSLv3': ssl.TLSVersion.SSLv3,
+    'TLSv1': ssl.TLSVersion.TLSv1,
+    'TLSv1.1': ssl.TLSVersion.TLSv1_1,
+    'TLSv1.2': ssl.TLSVersion.TLSv1_2,
+    'TLSv1.3': ssl.TLSVersion.TLSv1_3,
+}
+# Disables a protocol inside the range of minimum_version and maximum_version
+PROTOCOL_OPTIONS = {
+    'TLSv1': ssl.OP_NO_TLSv1,
+    'TLSv1.1': ssl.OP_NO_TLSv1_1,
+    'TLSv1.2': ssl.OP_NO_TLSv1_2,
+}
+HTTP_RESPONSE = b'HTTP/1.1 200 OK\r\nContent-Length: 2\r\nConnection: close\r\n\r\nok'
+
+
+def ssl_context(config: TLSConfig, cert_file: str = CERT_FILE, key_file: str = KEY_FILE) -> ssl.SSLContext:
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.load_cert_chain(cert_file, key_file)
+    versions = [PROTOCOL_VERSIONS[p] for p in config.ssl_protocols if p in PROTOCOL_VERSIONS]
+    if len(versions) > 0:
+        context.minimum_version = min(versions)
+        context.maximum_version = max(versions)
+    for protocol, option in PROTOCOL_OPTIONS.items():
+        if protocol not in config.ssl_protocols:
+            context.options |= option
+    try:
+        # Like the webservers, also allow the old protocols and ciphers that OpenSSL rejects by default
+        context.set_ciphers(':'.join(config.ssl_ciphers) + ':@SECLEVEL=0')
+    except ssl.SSLError:
+        # No cipher of the list is available, only TLS 1.3 can be negotiated
+        pass
+    if config.ssl_prefer_server_ciphers:
+        context.options |= ssl.OP_CIPHER_SERVER_PREFERENCE
+    if not config.ssl_session_tickets:
+        context.options |= ssl.OP_NO_TICKET
+    context.set_alpn_protocols(['h2', 'http/1.1'] if config.http2 else ['http/1.1'])
+    return context
+
+
+class _Handler(socketserver.BaseRequestHandler):
+    def handle(self):
+        try:
+            with self.server.context.wrap_socket(self.request, server_side=True) as conn:
+                conn.recv(4096)
+                conn.sendall(HTTP_RESPONSE)
+        except (ssl.SSLError, OSError):
+            # Scanners abort handshakes on purpose
+            pass
+
+
+class _Server(socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, port: int, context: ssl.SSLContext):
+        self.context = context
+        super().__init__(('127.0.0.1', port), _Handler)
+
+
+class StandInServers(object):
+    """One TLS server per config on consecutive ports, each served by its own thread like a container"""
+
+    def __init__(self, configs: List[TLSConfig], start_port: int):
+        self.configs = configs
+        self.start_port = start_port
+        self.servers: List[_Server] = []
+        self.threads: List[threading.Thread] = []
+
+    def start(self) -> List[int]:
+        for i, config in enumerate(self.configs):
+            server = _Server(self.start_port + i, ssl_context(config))
+            thread = threading.Thread(target=server.serve_forever, kwargs={'poll_interval': 0.05}, daemon=True)
+            thread.start()
+            self.servers.append(server)
+            self.threads.append(thread)
+        return [s.server_address[1] for s in self.servers]
+
+    def stop(self):
+        for server in self.servers:
+            server.shutdown()
+            server.server_close()
+        for thread in self.threads:
+            thread.join()
+        self.servers = []
+        self.threads = []
+
+    def __enter__(self) -> List[int]:
+        return self.start()
+
+    def __exit__(self, type, value, traceback):
+        self.stop()
+
+
+def handshake(port: int, server_name: str = 'example.com', timeout: float = 5) -> Tuple[bool, float]:
+    """Whether a TLS handshake with the server on port succeeded and how long it took"""
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+    context.check_hostname = False
+    context.verify_mode = ssl.CERT_NONE
+    context.minimum_version = ssl.TLSVersion.MINIMUM_SUPPORTED
+    context.set_ciphers('ALL:@SECLEVEL=0')
+    start = time.monotonic()
+    try:
+        with socket.create_connection(('127.0.0.1', port), timeout=timeout) as sock:
+            with context.wrap_socket(sock, server_hostname=server_name):
+                pass
+    except (ssl.SSLError, OSError):
+        return False, time.monotonic() - start
+    return True, time.monotonic() - start
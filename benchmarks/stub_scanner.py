@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+"""Stand-in for goscanner, testssl.sh, SSLyze, and tcpdump that replays outputs instead of scanning.
+
+    python3 -m benchmarks.stub_scanner <goscanner|testssl|sslyze|tcpdump> <arguments of the tool>
+
+The scanners make STUB_HANDSHAKES TLS handshakes with every target (e.g., the stand-in servers) and write one
+output record per target. A recording in DISSECTLS_STUB_RECORDINGS (testssl.json with the findings of one target,
+sslyze.json with one server scan result) is replayed with the fields of each target, without one the records of
+benchmarks.fixtures are used. tcpdump prints STUB_TCPDUMP_PACKETS Client Hellos to the ports of its filter.
+"""
+import copy
+import csv
+import json
+import os
+import random
+import re
+import signal
+import sys
+import threading
+from typing import List, Optional, Tuple
+
+import benchmarks.fixtures as fixtures
+from benchmarks.standin import handshake
+from pipeline.result_cache import parse_target
+
+RECORDINGS_ENV = 'DISSECTLS_STUB_RECORDINGS'
+HANDSHAKES_ENV = 'STUB_HANDSHAKES'
+PACKETS_ENV = 'STUB_TCPDUMP_PACKETS'
+
+PORT_RANGE = re.compile(r'tcp dst (?:port (\d+)|portrange (\d+)-(\d+))')
+
+
+def _option(args: List[str], name: str, default: Optional[str] = None) -> Optional[str]:
+    for i, arg in enumerate(args):
+        if arg == name and i + 1 < len(args):
+            return args[i + 1]
+        if arg.startswith(f'{name}='):
+            return arg[len(name) + 1:]
+    return default
+
+
+def _recording(name: str):
+    directory = os.environ.get(RECORDINGS_ENV)
+    if directory is None or not os.path.exists(os.path.join(directory, name)):
+        return None
+    with open(os.path.join(directory, name)) as f:
+        return json.load(f)
+
+
+def _probe(ip: str, port: str, server_name: str):
+    for _ in range(int(os.environ.get(HANDSHAKES_ENV, '1'))):
+        if ip in ['127.0.0.1', 'localhost']:
+            handshake(int(port), server_name)
+
+
+def goscanner(args: List[str]):
+    if args[0] == 'create-ch-input':
+        client_hellos = sorted(os.listdir(_option(args, '--ch-dir')))
+        with open(_option(args, '-i')) as f:
+            for line in f:
+                if line.strip() != '':
+                    for ch in client_hellos:
+                        print(f'{line.strip()},{ch}')
+        return
+    if args[0] == 'generate-fingerprints':
+        scanner_dir = _option(args, '--scanner-dir')
+        with open(os.path.join(scanner_dir, 'hosts.csv')) as f_in, \
+                open(os.path.join(scanner_dir, 'fingerprints.csv'), mode='w') as f_out:
+            writer = csv.writer(f_out)
+            writer.writerow(['ip', 'port', 'fingerprint'])
+            for host in csv.DictReader(f_in):
+                writer.writerow([host['ip'], host['port'], f'stub-{host["port"]}'])
+        return
+    output_dir = _option(args, '-o')
+    os.makedirs(output_dir, exist_ok=True)
+    conf = os.path.splitext(os.path.basename(_option(args, '-C', 'scan')))[0]
+    with open(_option(args, '-i')) as f:
+        targets = [parse_target(row) for row in csv.reader(f) if len(row) > 0]
+    with open(os.path.join(output_dir, 'hosts.csv'), mode='w') as hosts, \
+            open(os.path.join(output_dir, f'{conf}.csv'), mode='w') as results:
+        hosts_writer = csv.writer(hosts)
+        hosts_writer.writerow(['id', 'ip', 'port', 'server_name'])
+        results_writer = csv.writer(results)
+        results_writer.writerow(['id', conf])
+        for i, (ip, port, sni) in enumerate(targets):
+            _probe(ip, port, sni or 'example.com')
+            hosts_writer.writerow([i, ip, port, sni])
+            results_writer.writerow([i, f'{int(port):062d}'])
+    open(_option(args, '-l'), mode='a').close()
+
+
+def _testssl_target(line: str) -> Tuple[str, str, str]:
+    parts = line.split()
+    server_name, _, port = parts[-1].rpartition(':')
+    return _option(parts, '--ip'), port, server_name
+
+
+def testssl(args: List[str]):
+    with open(_option(args, '--file')) as f:
+        targets = [_testssl_target(line) for line in f if line.strip() != '']
+    recording = _recording('testssl.json')
+    rng = random.Random(0)
+    findings = []
+    for i, (ip, port, server_name) in enumerate(targets):
+        _probe(ip, port, server_name)
+        for finding in copy.deepcopy(recording) if recording is not None else fixtures.testssl_findings(i, rng):
+            finding.update(ip=f'{server_name}/{ip}', port=port)
+            findings.append(finding)
+        print(f'Done testing now all IP addresses (on port {port}): {ip}', flush=True)
+    with open(_option(args, '--jsonfile'), mode='w') as f:
+        json.dump(findings, f, indent=10)
+
+
+def _sslyze_target(line: str) -> Tuple[str, str, str]:
+    line = line.strip()
+    if line.endswith('}'):
+        server_name, _, ip = line[:-1].partition('{')
+        ip, port, _ = parse_target([ip])
+        return ip, port, server_name
+    ip, port, _ = parse_target([line])
+    return ip, port, ip
+
+
+def sslyze(args: List[str]):
+    with open(_option(args, '--targets_in')) as f:
+        targets = [_sslyze_target(line) for line in f if line.strip() != '']
+    recording = _recording('sslyze.json')
+    rng = random.Random(0)
+    results = []
+    for i, (ip, port, server_name) in enumerate(targets):
+        _probe(ip, port, server_name)
+        result = copy.deepcopy(recording) if recording is not None else fixtures.sslyze_server_scan_result(i, rng)
+        result['server_location'].update(hostname=server_name, ip_address=ip, port=int(port))
+        results.append(result)
+        print(f' SCAN RESULTS FOR {server_name}:{port} - {ip}', flush=True)
+    with open(_option(args, '--json_out'), mode='w') as f:
+        json.dump({'server_scan_results': results, 'invalid_server_strings': []}, f)
+
+
+def tcpdump(args: List[str]):
+    ports = []
+    for single, first, last in PORT_RANGE.findall(args[-1]):
+        ports.extend([int(single)] if single else range(int(first), int(last) + 1))
+    stop = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop.set())
+    print(f'listening on {_option(args, "-i", "any")}, link-type LINUX_SLL2', file=sys.stderr, flush=True)
+    packets = int(os.environ.get(PACKETS_ENV, '0')) if len(ports) > 0 else 0
+    for i in range(packets):
+        print(f'IP 127.0.0.1.{40000 + i % 20000} > 127.0.0.1.{ports[i % len(ports)]}: tcp 517')
+    sys.stdout.flush()
+    while not stop.wait(0.05):
+        pass
+    print(f'{packets} packets captured\n{packets} packets received by filter\n0 packets dropped by kernel',
+          file=sys.stderr, flush=True)
+
+
+TOOLS = {'goscanner': goscanner, 'testssl': testssl, 'sslyze': sslyze, 'tcpdump': tcpdump}
+
+
+if __name__ == '__main__':
+    TOOLS[sys.argv[1]](sys.argv[2:])
@@ -1,31 +1,64 @@
 import logging
 import os
 import pathlib
-from typing import Tuple
+import socket
+import ssl
+import time
+import threading
+from multiprocessing.pool import ThreadPool
+from typing import Dict, Tuple, List, Optional, Iterable
 
 import docker
+from docker import DockerClient
 from docker.models.containers import Container
 from docker.types import Mount
 
 START_AT_PORT = 10000
+# Packed containers listen on PACKED_CONTAINER_PORT + k for the config published on START_AT_PORT + k. The inner
+# ports stay below START_AT_PORT, so a capture of the published ports does not count the forwarded Client Hellos again.
+PACKED_CONTAINER_PORT = 2000
 
 
-def start_container(container: int, config_name: str) -> Tuple[str, int]:
+def packed_container_port(port: int) -> int:
+    return PACKED_CONTAINER_PORT + port - START_AT_PORT
+
+
+def start_container(container: int, config_name: str, client: Optional[DockerClient] = None) -> Tuple[str, int]:
+    try:
+        base_name = os.path.basename(config_name)
+        if base_name.startswith('apache'):
+            return start_container_apache(container, config_name, client)
+        elif base_name.startswith('nginx'):
+            return start_container_nginx(container, config_name, client)
+        else:
+            logging.fatal(f'Could not identify webserver for {config_name}')
+    except Exception as e:
+        logging.fatal(f'Could not start webserver {config_name}', exc_info=e)
+
+
+def start_packed_container(config_name: str, ports: List[int],
+                           client: Optional[DockerClient] = None) -> Optional[Tuple[str, List[int]]]:
+    """Start a container for a packed config that listens on the packed_container_port of each port"""
     try:
         base_name = os.path.basename(config_name)
+        published = {f'{packed_container_port(port)}/tcp': port for port in ports}
         if base_name.startswith('apache'):
-            return start_container_apache(container, config_name)
+            return run_container_apache(config_name, published, client), ports
         elif base_name.startswith('nginx'):
-            return start_container_nginx(container, config_name)
+            return run_container_nginx(config_name, published, client), ports
         else:
             logging.fatal(f'Could not identify webserver for {config_name}')
     except Exception as e:
         logging.fatal(f'Could not start webserver {config_name}', exc_info=e)
 
 
-def start_container_nginx(container: int, config_name: str) -> Tuple[str, int]:
-    client = docker.from_env()
+def start_container_nginx(container: int, config_name: str, client: Optional[DockerClient] = None) -> Tuple[str, int]:
     port = START_AT_PORT + container
+    return run_container_nginx(config_name, {'443/tcp': port}, client), port
+
+
+def run_container_nginx(config_name: str, ports: Dict[str, int], client: Optional[DockerClient] = None) -> str:
+    client = client or docker.from_env()
 
     config_path = os.path.abspath(config_name)
     certs_path = os.path.abspath('./certificates')
@@ -39,14 +72,17 @@ def start_container_nginx(container: int, config_name: str) -> Tuple[str, int]:
         Mount(target='/etc/nginx/html/index.html"', read_only=True,
               source=index_path, type="bind")
     ]
-    ports = {'443/tcp': port}
     container = client.containers.run("nginx:1.23", mounts=mounts, ports=ports,  detach=True)
-    return container.id, port
+    return container.id
 
 
-def start_container_apache(container: int, config_name: str) -> Tuple[str, int]:
-    client = docker.from_env()
+def start_container_apache(container: int, config_name: str, client: Optional[DockerClient] = None) -> Tuple[str, int]:
     port = START_AT_PORT + container
+    return run_container_apache(config_name, {'443/tcp': port}, client), port
+
+
+def run_container_apache(config_name: str, ports: Dict[str, int], client: Optional[DockerClient] = None) -> str:
+    client = client or docker.from_env()
 
     httpd_conf = os.path.abspath('./configs/httpd.conf')
     certs_path = os.path.abspath('./certificates')
@@ -60,20 +96,19 @@ def start_container_apache(container: int, config_name: str) -> Tuple[str, int]:
         Mount(target='/etc/certificates', read_only=True,
               source=certs_path, type="bind")
     ]
-    ports = {'443/tcp': port}
     container: Container = client.containers.run("httpd:2.4", mounts=mounts, ports=ports,  detach=True)
-    return container.id, port
+    return container.id
 
 
-def stop_container(container_id: str):
-    client = docker.from_env()
+def stop_container(container_id: str, client: Optional[DockerClient] = None):
+    client = client or docker.from_env()
     container = client.containers.get(container_id)
     container.stop()
     container.remove()
 
 
-def save_logs(debug_dir, config_name, container_id: str):
-    client = docker.from_env()
+def save_logs(debug_dir, config_name, container_id: str, client: Optional[DockerClient] = None):
+    client = client or docker.from_env()
     container = client.containers.get(container_id)
     logs_std = container.logs(stderr=False)
     logs_err = container.logs(stdout=False)
@@ -87,3 +122,233 @@ def save_logs(debug_dir, config_name, container_id: str):
         pathlib.Path(os.path.join(debug_dir, f'{name}.stderr.txt')).write_text(logs_err)
     except Exception as e:
         logging.error(f'Could not save logs for {name} in {debug_dir}', exc_info=e)
+
+
+RELOAD_COMMANDS = {
+    'nginx': (['nginx', '-t'], ['nginx', '-s', 'reload']),
+    'apache': (['apachectl', '-t'], ['apachectl', '-k', 'graceful']),
+}
+# PID and cmdline of every process in the container, used to wait for the workers of the old config to drain
+LIST_PROCESSES = ['sh', '-c', 'for p in /proc/[0-9]*; do echo "${p#/proc/} $(tr "\\0" " " < $p/cmdline)"; done']
+
+
+def wait_for_tls(port: int, host: str = '127.0.0.1', timeout: float = 30) -> bool:
+    """Wait until the server on port answers a ClientHello, a TLS alert counts as an answer as well"""
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+    context.check_hostname = False
+    context.verify_mode = ssl.CERT_NONE
+    context.minimum_version = ssl.TLSVersion.MINIMUM_SUPPORTED
+    try:
+        context.set_ciphers('ALL:@SECLEVEL=0')
+    except ssl.SSLError:
+        pass
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with socket.create_connection((host, port), timeout=2) as sock:
+                with context.wrap_socket(sock):
+                    return True
+        except (ssl.SSLEOFError, ssl.SSLZeroReturnError):
+            # The docker proxy accepts connections before the webserver listens
+            pass
+        except ssl.SSLError:
+            return True
+        except OSError:
+            pass
+        time.sleep(0.1)
+    logging.error(f'Webserver on port {port} did not answer within {timeout}s')
+    return False
+
+
+def list_workers(container: Container) -> dict:
+    exit_code, output = container.exec_run(LIST_PROCESSES)
+    workers = dict()
+    for line in output.decode(errors='ignore').splitlines():
+        pid, _, cmdline = line.partition(' ')
+        if pid != '1':
+            workers[pid] = cmdline
+    return workers
+
+
+def reload_container(webserver: str, container_id: str, drain_timeout: float = 10,
+                     client: Optional[DockerClient] = None) -> bool:
+    """Check and gracefully reload the config of a running webserver and wait until the old workers are drained"""
+    client = client or docker.from_env()
+    container = client.containers.get(container_id)
+    check_cmd, reload_cmd = RELOAD_COMMANDS[webserver]
+    exit_code, output = container.exec_run(check_cmd)
+    if exit_code != 0:
+        logging.error(f'Config of {container_id} is invalid: {output.decode(errors="ignore")}')
+        return False
+    old_workers = list_workers(container)
+    exit_code, output = container.exec_run(reload_cmd)
+    if exit_code != 0:
+        logging.error(f'Could not reload {container_id}: {output.decode(errors="ignore")}')
+        return False
+
+    deadline = time.monotonic() + drain_timeout
+    while time.monotonic() < deadline:
+        workers = list_workers(container)
+        # nginx renames draining workers, they no longer accept connections
+        if not any(pid in workers and 'shutting down' not in workers[pid] for pid in old_workers):
+            return True
+        time.sleep(0.1)
+    logging.warning(f'Workers of the previous config in {container_id} did not drain within {drain_timeout}s')
+    return True
+
+
+class ContainerManager:
+    """Runs container operations concurrently on a thread pool, every worker thread keeps its own Docker client"""
+
+    def __init__(self, workers: int = 32):
+        self._local = threading.local()
+        self._clients: List[DockerClient] = []
+        self._lock = threading.Lock()
+        self._pool = ThreadPool(workers)
+
+    def client(self) -> DockerClient:
+        """The Docker client of the calling worker thread, created on first use"""
+        client = getattr(self._local, 'client', None)
+        if client is None:
+            client = self._local.client = docker.from_env()
+            with self._lock:
+                self._clients.append(client)
+        return client
+
+    def _start_ready(self, slot: int, config_name: str, ready_timeout: float) -> Optional[Tuple[str, int]]:
+        started = start_container(slot, config_name, self.client())
+        if started is not None and not wait_for_tls(started[1], timeout=ready_timeout):
+            # A webserver that does not answer handshakes would only produce empty scan results
+            stop_container(started[0], self.client())
+            return None
+        return started
+
+    def start_many(self, config_names: Iterable[str], slots: Optional[Iterable[int]] = None,
+                   ready_timeout: float = 30) -> List[Tuple[str, int]]:
+        """Start a container per config, on the port of its slot, and wait until they answer a TLS handshake.
+
+        Raises RuntimeError if a container did not start or answer within ready_timeout, after stopping the others.
+        """
+        config_names = list(config_names)
+        slots = range(len(config_names)) if slots is None else slots
+        started = self._pool.starmap(self._start_ready, ((slot, name, ready_timeout)
+                                                          for slot, name in zip(slots, config_names)))
+        failed = [name for name, s in zip(config_names, started) if s is None]
+        if len(failed) > 0:
+            self.stop_many([s[0] for s in started if s is not None])
+            raise RuntimeError(f'Could not start webservers for {failed}')
+        return started
+
+    def _start_packed_ready(self, config_name: str, ports: List[int],
+                            ready_timeout: float) -> Optional[Tuple[str, List[int]]]:
+        started = start_packed_container(config_name, ports, self.client())
+        if started is not None and not all([wait_for_tls(port, timeout=ready_timeout) for port in ports]):
+            stop_container(started[0], self.client())
+            return None
+        return started
+
+    def start_packed_many(self, packs: Iterable[Tuple[str, List[int]]],
+                          ready_timeout: float = 30) -> List[Tuple[str, List[int]]]:
+        """Start a container per packed config and its ports, and wait until every port answers a TLS handshake"""
+        packs = list(packs)
+        started = self._pool.starmap(self._start_packed_ready, ((name, ports, ready_timeout) for name, ports in packs))
+        failed = [name for (name, _), s in zip(packs, started) if s is None]
+        if len(failed) > 0:
+            self.stop_many([s[0] for s in started if s is not None])
+            raise RuntimeError(f'Could not start webservers for {failed}')
+        return started
+
+    def wait_ready_many(self, ports: Iterable[int], ready_timeout: float = 30) -> List[bool]:
+        return self._pool.map(lambda port: wait_for_tls(port, timeout=ready_timeout), ports)
+
+    def stop_many(self, container_ids: Iterable[str]):
+        self._pool.map(lambda c: stop_container(c, self.client()), container_ids)
+
+    def reload_many(self, webserver: str, container_ids: Iterable[str]) -> List[bool]:
+        return self._pool.map(lambda c: reload_container(webserver, c, client=self.client()), container_ids)
+
+    def save_logs_many(self, debug_dir: str, config_names: Iterable[str], container_ids: Iterable[str]):
+        pathlib.Path(debug_dir).mkdir(exist_ok=True)
+        self._pool.starmap(lambda n, c: save_logs(debug_dir, n, c, self.client()), zip(config_names, container_ids))
+
+    def prune(self):
+        self._pool.apply(lambda: self.client().containers.prune())
+
+    def close(self):
+        self._pool.close()
+        self._pool.join()
+        for client in self._clients:
+            client.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+
+class WarmContainerPool:
+    """Keeps one container per slot running and swaps in new configs with a graceful reload.
+
+    The config of each slot is bind-mounted from a fixed file that is rewritten in place, so the containers see
+    the new content without being recreated.
+    """
+
+    def __init__(self, manager: ContainerManager, webserver: str, config_dir: str):
+        self.manager = manager
+        self.webserver = webserver
+        self.config_dir = config_dir
+        self.containers: List[str] = []
+        self.ports: List[int] = []
+
+    def slot_config(self, slot: int) -> str:
+        return os.path.join(self.config_dir, f'{self.webserver}_slot_{slot}.conf')
+
+    def load(self, configs: List[str]) -> List[int]:
+        """Serve the given rendered configs and return their ports"""
+        pathlib.Path(self.config_dir).mkdir(parents=True, exist_ok=True)
+        running = min(len(configs), len(self.containers))
+        changed = []
+        for slot, config in enumerate(configs):
+            path = pathlib.Path(self.slot_config(slot))
+            if slot < running and path.read_text() == config:
+                # Same config as before, the container can keep serving it
+                continue
+            path.write_text(config)
+            if slot < running:
+                changed.append(slot)
+
+        reloaded = self.manager.reload_many(self.webserver, [self.containers[slot] for slot in changed])
+        # Fall back to fresh containers, e.g., to get the error of an invalid config into their logs
+        self._restart([slot for slot, ok in zip(changed, reloaded) if not ok])
+
+        new_slots = range(running, len(configs))
+        for container_id, port in self.manager.start_many(map(self.slot_config, new_slots), slots=new_slots):
+            self.containers.append(container_id)
+            self.ports.append(port)
+
+        # Containers that do not answer after the reload are recreated, start_many raises if they still do not
+        ready = self.manager.wait_ready_many(self.ports[:running])
+        self._restart([slot for slot, ok in enumerate(ready) if not ok])
+        return self.ports[:len(configs)]
+
+    def _restart(self, slots: List[int]):
+        if len(slots) == 0:
+            return
+        self.manager.stop_many([self.containers[slot] for slot in slots])
+        try:
+            restarted = self.manager.start_many(map(self.slot_config, slots), slots=slots)
+        except RuntimeError:
+            # The stopped containers are gone, close() must not stop them again
+            for slot in sorted(slots, reverse=True):
+                del self.containers[slot], self.ports[slot]
+            raise
+        for slot, (container_id, port) in zip(slots, restarted):
+            self.containers[slot], self.ports[slot] = container_id, port
+
+    def close(self, debug_dir: Optional[str] = None):
+        if debug_dir is not None:
+            self.manager.save_logs_many(debug_dir, map(self.slot_config, range(len(self.containers))), self.containers)
+        self.manager.stop_many(self.containers)
+        self.containers = []
+        self.ports = []
@@ -0,0 +1,155 @@
+import hashlib
+import json
+from functools import lru_cache
+from typing import Callable, Dict, Iterable, Tuple
+
+# Marks a field that a projection leaves out
+DROP = None
+
+# Volatile fields of an sslyze scan_result: the ephemeral keys, error messages and OpenSSL names differ between scans
+SSLYZE_PROJECTION = {'*': {'result': {
+    'accepted_cipher_suites': [{'ephemeral_key': DROP, 'cipher_suite': {'openssl_name': DROP}}],
+    'rejected_cipher_suites': [{'error_message': DROP, 'cipher_suite': {'openssl_name': DROP}}],
+}}}
+
+SECTIONS = ['protocols', 'ciphers', 'extensions', 'other']
+
+SSLYZE_EXTENSIONS = {'elliptic_curves', 'session_resumption', 'session_renegotiation', 'tls_fallback_scsv',
+                     'tls_1_3_early_data'}
+TESTSSL_PROTOCOLS = {'SSLv2', 'SSLv3', 'TLS1', 'TLS1_1', 'TLS1_2', 'TLS1_3'}
+TESTSSL_EXTENSIONS = {'NPN', 'ALPN', 'ALPN_HTTP2', 'TLS_extensions', 'SSL_sessionID_support',
+                      'sessionresumption_ticket', 'sessionresumption_ID', 'secure_renego', 'secure_client_renego',
+                      'fallback_SCSV', 'PFS_ECDHE_curves', 'DH_groups'}
+
+_ENCODER = json.JSONEncoder(sort_keys=True)
+_encode_string = json.encoder.encode_basestring_ascii
+if json.encoder.c_make_encoder is not None:
+    # The C encoder that json.dumps(sort_keys=True) builds on every call, built once. Without circular reference
+    # checks, parsed scanner output has none.
+    _c_encoder = json.encoder.c_make_encoder(None, _ENCODER.default, _encode_string, None, ': ', ', ', True, False,
+                                             True)
+
+    def _encode(value) -> str:
+        return ''.join(_c_encoder(value, 0))
+else:
+    _encode = _ENCODER.encode
+
+
+def compile_projection(schema) -> Callable:
+    """Function returning a copy of a value without the fields that schema maps to DROP, parts that schema does not
+    touch are shared with the value.
+
+    A dict schema applies per key ('*' for any key) and a list schema with one element to every list item. Values
+    that do not have the type of their schema (e.g., null) are kept as they are.
+    """
+    if isinstance(schema, list):
+        item = compile_projection(schema[0])
+        return lambda value: [item(v) for v in value] if isinstance(value, list) else value
+    drops = [key for key, sub_schema in schema.items() if sub_schema is DROP and key != '*']
+    subs = [(key, compile_projection(sub_schema)) for key, sub_schema in schema.items()
+            if sub_schema is not DROP and key != '*']
+    wildcard = compile_projection(schema['*']) if schema.get('*') is not None else None
+
+    def projection(value):
+        if not isinstance(value, dict):
+            return value
+        # Copying and removing keys is much cheaper than building the dict key by key
+        value = {key: wildcard(v) for key, v in value.items()} if wildcard is not None else value.copy()
+        for key in drops:
+            value.pop(key, None)
+        for key, sub_projection in subs:
+            if key in value:
+                value[key] = sub_projection(value[key])
+        return value
+    return projection
+
+
+project_sslyze = compile_projection(SSLYZE_PROJECTION)
+
+
+@lru_cache(maxsize=None)
+def sslyze_section(key: str) -> str:
+    if key.endswith('_cipher_suites'):
+        return 'ciphers'
+    if key in SSLYZE_EXTENSIONS:
+        return 'extensions'
+    return 'other'
+
+
+@lru_cache(maxsize=None)
+def testssl_section(key: str) -> str:
+    if key in TESTSSL_PROTOCOLS:
+        return 'protocols'
+    if key.startswith('cipher'):
+        return 'ciphers'
+    if key in TESTSSL_EXTENSIONS:
+        return 'extensions'
+    return 'other'
+
+
+def sslyze_protocols(scan_result: dict) -> dict:
+    """Whether sslyze found a protocol version supported, the protocols section of an sslyze fingerprint"""
+    protocols = dict()
+    for key, test_result in scan_result.items():
+        result = test_result.get('result') if isinstance(test_result, dict) else None
+        if key.endswith('_cipher_suites') and isinstance(result, dict):
+            protocols[key[:-len('_cipher_suites')]] = result.get('is_tls_version_supported')
+    return protocols
+
+
+def _sha256_object(members: Iterable[str]) -> str:
+    """SHA-256 of the JSON object with the encoded members, fed member by member without joining them first"""
+    h = hashlib.sha256(b'{')
+    separator = b''
+    for member in members:
+        h.update(separator)
+        h.update(member.encode())
+        separator = b', '
+    h.update(b'}')
+    return h.hexdigest()
+
+
+_EMPTY_HASH = _sha256_object([])
+
+
+def canonical_fingerprint(obj, section: Callable[[str], str],
+                          extra_sections: Dict[str, dict] = None) -> Tuple[str, str, Dict[str, str]]:
+    """Hash, canonical JSON and per-section hashes of a fingerprint.
+
+    The JSON and hash are the same as json.dumps(obj, sort_keys=True) and its SHA-256. Every top-level member is
+    encoded once and fed to the hash of the fingerprint and the hash of its section, the SHA-256 of the JSON object
+    with only the members of that section. extra_sections adds members to a section that are not part of obj.
+    """
+    if not isinstance(obj, dict):
+        raw = _encode(obj)
+        return hashlib.sha256(raw.encode()).hexdigest(), raw, {name: _EMPTY_HASH for name in SECTIONS}
+
+    h = hashlib.sha256()
+    update = h.update
+    section_hashes = dict()
+    members = []
+    separator = b'{'
+    for key in sorted(obj):
+        value = obj[key]
+        # Most testssl.sh findings are strings, which do not need the full encoder
+        member = f'{_encode_string(key)}: {_encode_string(value) if type(value) is str else _encode(value)}'
+        data = member.encode()
+        update(separator + data)
+        separator = b', '
+        members.append(member)
+        name = section(key)
+        section_hash = section_hashes.get(name)
+        if section_hash is None:
+            section_hashes[name] = hashlib.sha256(b'{' + data)
+        else:
+            section_hash.update(b', ' + data)
+    update(b'}' if len(members) > 0 else b'{}')
+
+    hashes = {name: _EMPTY_HASH for name in SECTIONS}
+    for name, section_hash in section_hashes.items():
+        section_hash.update(b'}')
+        hashes[name] = section_hash.hexdigest()
+    for name, extra_members in (extra_sections or dict()).items():
+        merged = {**{key: obj[key] for key in obj if section(key) == name}, **extra_members}
+        hashes[name] = _sha256_object(f'{_encode_string(key)}: {_encode(merged[key])}' for key in sorted(merged))
+    return h.hexdigest(), f'{{{", ".join(members)}}}', hashes
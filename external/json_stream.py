@@ -0,0 +1,92 @@
+import json
+import re
+from typing import Any, Iterator, Optional, TextIO
+
+READ_SIZE = 1 << 20
+WHITESPACE = ' \t\n\r'
+DELIMITERS = WHITESPACE + ',:]}'
+SKIP_WHITESPACE = re.compile(r'[ \t\n\r]*').match
+
+
+class _Reader:
+    """Sliding window over a text file that only keeps the not yet decoded part in memory"""
+
+    def __init__(self, f: TextIO, decoder: json.JSONDecoder, read_size: int):
+        self.f = f
+        self.decoder = decoder
+        self.read_size = read_size
+        self.buf = ''
+        self.pos = 0
+        self.eof = False
+
+    def _fill(self) -> bool:
+        if self.eof:
+            return False
+        # Read at least as much as is currently buffered to keep re-decoding of large values linear
+        data = self.f.read(max(self.read_size, len(self.buf) - self.pos))
+        if data == '':
+            self.eof = True
+            return False
+        self.buf = self.buf[self.pos:] + data
+        self.pos = 0
+        return True
+
+    def peek(self) -> str:
+        while True:
+            self.pos = SKIP_WHITESPACE(self.buf, self.pos).end()
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self._fill():
+                raise ValueError('Unexpected end of JSON input')
+
+    def expect(self, char: str):
+        found = self.peek()
+        if found != char:
+            raise ValueError(f'Expected {char!r} at offset {self.pos}, found {found!r}')
+        self.pos += 1
+
+    def value(self) -> Any:
+        self.peek()
+        while True:
+            try:
+                obj, end = self.decoder.raw_decode(self.buf, self.pos)
+                # A number at the end of the window might continue in the next read
+                if self.eof or (end < len(self.buf) and self.buf[end] in DELIMITERS):
+                    self.pos = end
+                    return obj
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            self._fill()
+
+
+def iter_array(f: TextIO, key: Optional[str] = None, strict: bool = True,
+               read_size: int = READ_SIZE) -> Iterator[Any]:
+    """Yield the elements of a JSON array one at a time without loading the whole document.
+
+    If key is None the document itself has to be an array, otherwise the array is looked up under key in the
+    top-level object. Other top-level values are decoded and dropped, they are expected to be small.
+    """
+    reader = _Reader(f, json.JSONDecoder(strict=strict), read_size)
+    if key is not None:
+        reader.expect('{')
+        if reader.peek() == '}':
+            return
+        while True:
+            name = reader.value()
+            reader.expect(':')
+            if name == key:
+                break
+            reader.value()
+            if reader.peek() == '}':
+                return
+            reader.expect(',')
+
+    reader.expect('[')
+    if reader.peek() == ']':
+        return
+    while True:
+        yield reader.value()
+        if reader.peek() == ']':
+            return
+        reader.expect(',')
@@ -0,0 +1,134 @@
+import logging
+import logging.handlers
+import os
+import random
+import re
+import signal
+import subprocess
+import threading
+import time
+from collections import deque
+from typing import Callable, List, Optional
+
+import pipeline.telemetry as telemetry
+
+LOG_MAX_BYTES = 16 << 20
+LOG_BACKUPS = 3
+# Lines longer than this are split, so that a child that never writes a newline cannot fill the memory
+MAX_LINE = 1 << 16
+TAIL_LINES = 20
+TERMINATE_GRACE = 10
+
+# Lines that the scanners print once per finished target
+TESTSSL_PROGRESS = re.compile(r'Done testing now all IP addresses')
+SSLYZE_PROGRESS = re.compile(r'SCAN RESULTS FOR')
+
+
+class Cancelled(Exception):
+    pass
+
+
+class ProgressLogger(object):
+    """Progress callback that logs every finished target"""
+
+    def __init__(self, name: str, total: Optional[int] = None):
+        self.name = name
+        self.total = total
+
+    def __call__(self, done: int, line: str):
+        total = f'/{self.total}' if self.total is not None else ''
+        logging.info(f'{self.name}: {done}{total} targets done')
+
+
+def _open_log(log_file: str) -> logging.Logger:
+    # Not registered with logging.getLogger, so that the logger goes away with the run
+    logger = logging.Logger(log_file, level=logging.INFO)
+    handler = logging.handlers.RotatingFileHandler(log_file, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUPS)
+    handler.setFormatter(logging.Formatter('%(message)s'))
+    logger.addHandler(handler)
+    return logger
+
+
+def _kill(process: subprocess.Popen):
+    """Terminate the process group of process (e.g., the workers of testssl.sh --parallel) and reap it"""
+    for sig, grace in [(signal.SIGTERM, TERMINATE_GRACE), (signal.SIGKILL, None)]:
+        try:
+            os.killpg(process.pid, sig)
+        except ProcessLookupError:
+            pass
+        try:
+            telemetry.wait4(process, grace)
+            return
+        except subprocess.TimeoutExpired:
+            continue
+
+
+def run(cmd: List[str], log_file: str, timeout: Optional[float] = None, stdout: Optional[str] = None,
+        progress_pattern: Optional[re.Pattern] = None, progress: Optional[Callable[[int, str], None]] = None,
+        cancel: Optional[threading.Event] = None) -> int:
+    """Run cmd and stream its output to log_file, which is rotated at LOG_MAX_BYTES, and return the number of lines
+    that matched progress_pattern.
+
+    With stdout, the standard output goes to that file and only the standard error to the log. Every line matching
+    progress_pattern calls progress with the number of matches so far. On timeout, cancel, or an interrupt the
+    whole process group is killed. Raises CalledProcessError with the last lines of the log as output.
+    """
+    logger = _open_log(log_file)
+    tail = deque(maxlen=TAIL_LINES)
+    matches = [0]
+
+    def read(pipe):
+        while True:
+            line = pipe.readline(MAX_LINE)
+            if not line:
+                break
+            line = line.decode(errors='replace').rstrip('\r\n')
+            logger.info(line)
+            tail.append(line)
+            if progress_pattern is not None and progress_pattern.search(line):
+                matches[0] += 1
+                if progress is not None:
+                    progress(matches[0], line)
+
+    stdout_file = open(stdout, mode='wb') if stdout is not None else None
+    try:
+        with subprocess.Popen(cmd, stdin=subprocess.DEVNULL, stdout=stdout_file or subprocess.PIPE,
+                              stderr=subprocess.PIPE if stdout_file else subprocess.STDOUT,
+                              start_new_session=True) as process:
+            reader = threading.Thread(target=read, args=(process.stderr if stdout_file else process.stdout,),
+                                      daemon=True)
+            reader.start()
+            deadline = None if timeout is None else time.monotonic() + timeout
+            try:
+                while True:
+                    if cancel is not None and cancel.is_set():
+                        raise Cancelled(f'{cmd[0]} was cancelled')
+                    if deadline is not None and time.monotonic() >= deadline:
+                        raise subprocess.TimeoutExpired(cmd, timeout, output=os.linesep.join(tail))
+                    try:
+                        telemetry.wait4(process, 0.5)
+                        break
+                    except subprocess.TimeoutExpired:
+                        continue
+            except BaseException:
+                _kill(process)
+                raise
+            finally:
+                reader.join()
+    finally:
+        if stdout_file is not None:
+            stdout_file.close()
+        for handler in logger.handlers:
+            handler.close()
+    if process.returncode != 0:
+        raise subprocess.CalledProcessError(process.returncode, cmd, output=os.linesep.join(tail))
+    return matches[0]
+
+
+def shuffle_lines(input_file: str, output_file: str, seed: Optional[int] = None):
+    """Write the lines of input_file in random order to output_file, the same seed gives the same order"""
+    with open(input_file) as f:
+        lines = [line if line.endswith('\n') else line + '\n' for line in f if line.strip() != '']
+    random.Random(seed).shuffle(lines)
+    with open(output_file, mode='w') as f:
+        f.writelines(lines)
@@ -1,69 +1,175 @@
 import codecs
 import csv
-import hashlib
 import json
 import logging
 import os
 import pathlib
+import re
+import shlex
 import shutil
+import signal
 import subprocess
-from typing import Optional
+import threading
+import time
+from collections import OrderedDict, Counter
+from contextlib import contextmanager
+from typing import Optional, Iterable, Iterator, Tuple
 
 import validators
 
+import external.fingerprint as fingerprint
+import external.json_stream as json_stream
+import external.runner as runner
+import pipeline.telemetry as telemetry
 from main import CURRENT_DIR
 
 GOSCANNER_DISSECTLS_CONF = f"{CURRENT_DIR}/goscanner/dissectls.conf"
 GOSCANNER_JARM_CONF = f"{CURRENT_DIR}/goscanner/jarm.conf"
 GOSCANNER_ATSF_CONF = f"{CURRENT_DIR}/goscanner/atsf.conf"
 
-
-def tcpdump_start(port: Optional[int], interface: str = 'any'):
-    p_query = f'tcp port {port} and ' if port is not None else ''
-    # Capture only Client Hellos
-    cmd = ['tcpdump', '-i', interface, '--count',
-           f'{p_query}(tcp[((tcp[12] & 0xf0) >>2)] = 0x16) && (tcp[((tcp[12] & 0xf0) >>2)+5] = 0x01)']
-    p = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
-    return p
-
-
-def tcpdump_stop(p: subprocess.Popen):
-    p.terminate()
-    try:
-        outs, errs = p.communicate(timeout=15)
-    except:
-        p.kill()
-        outs, errs = p.communicate(timeout=15)
-    if 'packets captured' not in outs:
-        logging.error(outs)
-        return None, None
-    else:
+# The scan options, part of the key of cached scan results
+TESTSSL_FLAGS = '-e -s -f -p -P -S -q -g --connect-timeout 15 --openssl-timeout 15 --nodns none'
+TESTSSL_DEFAULT_SNI = 'example.com'
+SSLYZE_FLAGS = ['--sslv2', '--sslv3', '--tlsv1', '--tlsv1_1', '--tlsv1_2', '--tlsv1_3', '--elliptic_curves',
+                '--compression', '--resum', '--fallback', '--reneg', '--early_data']
+# Command that runs SSLyze, e.g., to use another installation or a stub in the benchmarks
+SSLYZE_ENV = 'DISSECTLS_SSLYZE'
+SSLYZE_DEFAULT_CMD = 'python3 -m sslyze'
+
+# fingerprints.csv of sslyze and testssl.sh, followed by the hashes of the sections of the fingerprint
+FINGERPRINT_HEADER = ['ip', 'port', 'server_name', 'fingerprint', 'fingerprint_raw',
+                      *(f'fingerprint_{name}' for name in fingerprint.SECTIONS)]
+# Recorded for every fingerprints.csv in the manifest of generate-fingerprints, increase it when the format changes
+# to regenerate the existing files. 2 added the section hashes.
+FINGERPRINT_FORMAT_VERSION = 2
+
+
+# Targets that group_testssl_findings remembers after writing them, to warn when their findings continue
+MAX_EVICTED_TARGETS = 4096
+
+
+# Only Client Hellos: TLS handshake record with handshake type 1
+CLIENT_HELLO_FILTER = '(tcp[((tcp[12] & 0xf0) >>2)] = 0x16) && (tcp[((tcp[12] & 0xf0) >>2)+5] = 0x01)'
+DST_PORT = re.compile(r' > \S+\.(\d+): ')
+
+
+def port_filter(ports: Iterable[int]) -> str:
+    """BPF expression matching the destination ports, consecutive ports are merged into port ranges"""
+    ranges = []
+    for port in sorted(set(ports)):
+        if len(ranges) > 0 and ranges[-1][1] == port - 1:
+            ranges[-1][1] = port
+        else:
+            ranges.append([port, port])
+    parts = [f'tcp dst port {a}' if a == b else f'tcp dst portrange {a}-{b}' for a, b in ranges]
+    return f'({" or ".join(parts)})'
+
+
+class ClientHelloCapture(object):
+    """A single tcpdump capturing the Client Hellos sent to a set of ports, counted per destination port.
+
+    start() returns once tcpdump reports that it is listening, stop() waits until no Client Hello was seen for
+    quiet_period seconds (at most drain_timeout) before it terminates tcpdump. stop() returns None if tcpdump failed,
+    i.e., did not report its statistics.
+    """
+
+    def __init__(self, ports: Optional[Iterable[int]], interface: str = 'any', arm_timeout: float = 10,
+                 quiet_period: float = 0.5, drain_timeout: float = 5):
+        self.ports = list(ports) if ports is not None else None
+        self.interface = interface
+        self.arm_timeout = arm_timeout
+        self.quiet_period = quiet_period
+        self.drain_timeout = drain_timeout
+        self.counts: Counter = Counter()
+        self.stats = dict()
+        self.process: Optional[subprocess.Popen] = None
+        # Resources and run time of tcpdump, known after stop()
+        self.rusage = None
+        self.wall = 0.0
+        self._armed = threading.Event()
+        self._last_packet = 0.0
+        self._threads = []
+
+    def start(self):
+        query = CLIENT_HELLO_FILTER if self.ports is None else f'{port_filter(self.ports)} and {CLIENT_HELLO_FILTER}'
+        cmd = ['tcpdump', '-i', self.interface, '-nn', '-q', '-t', '-l', query]
+        self.process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+        self._started = time.monotonic()
+        self._last_packet = self._started
+        self._threads = [threading.Thread(target=self._read_packets, daemon=True),
+                         threading.Thread(target=self._read_messages, daemon=True)]
+        for t in self._threads:
+            t.start()
+        if not self._armed.wait(self.arm_timeout):
+            logging.error(f'tcpdump did not start listening on {self.interface} within {self.arm_timeout}s')
+
+    def _read_packets(self):
+        for line in self.process.stdout:
+            match = DST_PORT.search(line)
+            if match is not None:
+                self.counts[int(match.group(1))] += 1
+                self._last_packet = time.monotonic()
+
+    def _read_messages(self):
+        for line in self.process.stderr:
+            if line.startswith('listening on'):
+                self._armed.set()
+            elif 'verbose output suppressed' in line:
+                continue
+            elif 'packets' in line:
+                count, _, name = line.strip().partition(' packets ')
+                self.stats[name] = int(count)
+            else:
+                logging.error(f'tcpdump: {line.strip()}')
+        self._armed.set()
+
+    def stop(self) -> Optional[Counter]:
+        deadline = time.monotonic() + self.drain_timeout
+        while time.monotonic() < deadline and time.monotonic() - self._last_packet < self.quiet_period:
+            time.sleep(0.05)
+        # Not Popen.terminate(), its poll() would reap a tcpdump that already exited (e.g., without permission to
+        # capture) and wait4 could no longer collect its resources
+        os.kill(self.process.pid, signal.SIGTERM)
         try:
-            lines = outs.splitlines()
-            captured = lines[-3].split()[0]
-            received = lines[-2].split()[0]
-            return captured, received
-        except Exception as e:
-            logging.fatal(f'could not extract data from: {outs} {lines}', exc_info=e)
-
-
-def goscanner_normal(goscanner_bin: str, input_file: str, output_dir: str):
+            self.rusage = telemetry.wait4(self.process, timeout=15, record=False)
+        except subprocess.TimeoutExpired:
+            os.kill(self.process.pid, signal.SIGKILL)
+            self.rusage = telemetry.wait4(self.process, timeout=15, record=False)
+        self.wall = time.monotonic() - self._started
+        for t in self._threads:
+            t.join(timeout=15)
+        if 'captured' not in self.stats:
+            logging.error(f'tcpdump did not report its statistics, exit code {self.process.returncode}')
+            return None
+        if self.stats.get('dropped by kernel', 0) > 0:
+            logging.warning(f'tcpdump dropped {self.stats["dropped by kernel"]} packets')
+        return self.counts
+
+
+def goscanner_normal(goscanner_bin: str, input_file: str, output_dir: str, seed: Optional[int] = None):
     log_file = f'{output_dir}.log'
     new_input_file = f'{output_dir}.input'
     pathlib.Path(output_dir).parent.mkdir(exist_ok=True, parents=True)
     shutil.rmtree(output_dir, ignore_errors=True)
 
-    subprocess.check_output(
-        f'{goscanner_bin} create-ch-input --ch-dir {CURRENT_DIR}/goscanner/client-hellos -i {input_file} | shuf > {new_input_file}',
-        shell=True)
-    subprocess.check_output([goscanner_bin, '-C', GOSCANNER_ATSF_CONF, '-i', new_input_file, '-o', output_dir, '-l', log_file])
+    runner.run([goscanner_bin, 'create-ch-input', '--ch-dir', f'{CURRENT_DIR}/goscanner/client-hellos', '-i', input_file],
+               stdout_log(output_dir), stdout=f'{new_input_file}.ordered')
+    runner.shuffle_lines(f'{new_input_file}.ordered', new_input_file, seed)
+    os.remove(f'{new_input_file}.ordered')
+    runner.run([goscanner_bin, '-C', GOSCANNER_ATSF_CONF, '-i', new_input_file, '-o', output_dir, '-l', log_file],
+               stdout_log(output_dir))
+
+
+def stdout_log(output_dir: str) -> str:
+    """Log of the output of the scanner process, next to the log goscanner writes itself"""
+    return f'{output_dir}.stdout.log'
 
 
 def generate_goscanner_fps(goscanner_bin: str, output_dir: str):
     temp_sorting_dir = f'{output_dir}.tmp'
     pathlib.Path(temp_sorting_dir).mkdir(exist_ok=True)
-    subprocess.check_output(
-        [goscanner_bin, 'generate-fingerprints', '--ch-dir', f'{CURRENT_DIR}/goscanner/client-hellos', '--scanner-dir', output_dir, '--tmp-dir', temp_sorting_dir])
+    runner.run([goscanner_bin, 'generate-fingerprints', '--ch-dir', f'{CURRENT_DIR}/goscanner/client-hellos',
+                '--scanner-dir', output_dir, '--tmp-dir', temp_sorting_dir], f'{output_dir}.fingerprints.log')
     shutil.rmtree(temp_sorting_dir, ignore_errors=True)
 
 
@@ -71,26 +177,28 @@ def goscanner_deep_tls(goscanner_bin: str, input_file: str, number_of_chs: int,
     pathlib.Path(output_dir).parent.mkdir(exist_ok=True, parents=True)
     log_file = f'{output_dir}.log'
     shutil.rmtree(output_dir, ignore_errors=True)
-    subprocess.check_output([goscanner_bin, '-C', GOSCANNER_DISSECTLS_CONF, '-i', input_file, '-o', output_dir,
-                             '--dissectls-max-chs', str(number_of_chs), '-l', log_file])
+    runner.run([goscanner_bin, '-C', GOSCANNER_DISSECTLS_CONF, '-i', input_file, '-o', output_dir,
+                '--dissectls-max-chs', str(number_of_chs), '-l', log_file], stdout_log(output_dir))
 
 
 def goscanner_jarm(goscanner_bin: str, input_file: str, output_dir: str):
     pathlib.Path(output_dir).parent.mkdir(exist_ok=True, parents=True)
     log_file = f'{output_dir}.log'
     shutil.rmtree(output_dir, ignore_errors=True)
-    subprocess.check_output(
-        [goscanner_bin, '-C', GOSCANNER_JARM_CONF, '-i', input_file, '-o', output_dir, '-l', log_file])
+    runner.run([goscanner_bin, '-C', GOSCANNER_JARM_CONF, '-i', input_file, '-o', output_dir, '-l', log_file],
+               stdout_log(output_dir))
 
 
-def sslyze(input_file: str, output_dir: str):
+def sslyze(input_file: str, output_dir: str, timeout: float = 7200):
     pathlib.Path(output_dir).mkdir(exist_ok=True, parents=True)
     output_file = os.path.join(output_dir, f'sslyze.json')
     new_input = f'{output_dir}.input'
 
+    targets = 0
     with pathlib.Path(new_input).open(mode='w') as f:
         with pathlib.Path(input_file).open() as f2:
             for row in csv.reader(f2):
+                targets += 1
                 if len(row) > 1:
                     host = row[1]
                     ip = row[0]
@@ -99,58 +207,70 @@ def sslyze(input_file: str, output_dir: str):
                     f.write(f'{host}{{{ip}}}' + os.linesep)
                 else:
                     f.write(row[0] + os.linesep)
+    sslyze_cmd = shlex.split(os.environ.get(SSLYZE_ENV, SSLYZE_DEFAULT_CMD))
     # Need to extract "scan_result" and remove tls1_3 "public_bytes"
-    subprocess.check_output(
-        ['python3', '-m', 'sslyze', '--targets_in', new_input, f'--json_out={output_file}', '--sslv2', '--sslv3',
-         '--tlsv1', '--tlsv1_1', '--tlsv1_2', '--tlsv1_3', '--elliptic_curves', '--compression', '--resum',
-         '--fallback', '--reneg', '--early_data'], timeout=7200)
+    runner.run([*sslyze_cmd, '--targets_in', new_input, f'--json_out={output_file}', *SSLYZE_FLAGS],
+               stdout_log(output_dir), timeout=timeout,
+               progress_pattern=runner.SSLYZE_PROGRESS, progress=runner.ProgressLogger(output_dir, targets))
 
 
-def generate_sslyze_fingerprints(output_dir: str):
+def generate_sslyze_fingerprints(output_dir: str, streaming: bool = True) -> int:
+    """Write fingerprints.csv for an sslyze.json and return the number of targets, streaming reads one server scan
+    result at a time"""
     output_file = os.path.join(output_dir, f'sslyze.json')
-    fp_file = os.path.join(output_dir, f'fingerprints.csv')
 
     with pathlib.Path(output_file).open() as f:
-        json_result = json.load(f)
-
-    with pathlib.Path(fp_file).open(mode='w') as f:
-        writer = csv.writer(f)
-        writer.writerow(['ip', 'port', 'server_name', 'fingerprint', 'fingerprint_raw'])
-        for server_scan_results in json_result.get('server_scan_results'):
-            location = server_scan_results.get('server_location')
-
-            scan_result: dict = server_scan_results.get('scan_result')
-            if scan_result is not None:
-                for sslyze_test, test_result in scan_result.items():
-                    result = test_result.get('result')
-                    if result is not None:
-                        accepted_cipher_suites = result.get('accepted_cipher_suites')
-                        if accepted_cipher_suites is not None:
-                            for accepted_cipher_suite in accepted_cipher_suites:
-                                del accepted_cipher_suite['ephemeral_key']
-                                if accepted_cipher_suite.get('cipher_suite') is not None:
-                                    del accepted_cipher_suite['cipher_suite']['openssl_name']
-                        rejected_cipher_suites = result.get('rejected_cipher_suites')
-                        if rejected_cipher_suites is not None:
-                            for rejected_cipher_suite in rejected_cipher_suites:
-                                del rejected_cipher_suite['error_message']
-                                if rejected_cipher_suite.get('cipher_suite') is not None:
-                                    del rejected_cipher_suite['cipher_suite']['openssl_name']
-
-            fp = json.dumps(scan_result, sort_keys=True)
-            fp_hashed = hashlib.sha256(fp.encode()).hexdigest()
-
-            writer.writerow([location['ip_address'], location['port'], location['hostname'], fp_hashed, fp])
-
-
-def testssl(testssl_bin: str, input_file: str, output_dir: str):
+        if streaming:
+            server_scan_results = json_stream.iter_array(f, 'server_scan_results')
+        else:
+            server_scan_results = json.load(f).get('server_scan_results')
+
+        with fingerprints_writer(output_dir) as writer:
+            targets = 0
+            for server_scan_result in server_scan_results:
+                writer.writerow(sslyze_fingerprint_row(server_scan_result))
+                targets += 1
+    return targets
+
+
+@contextmanager
+def fingerprints_writer(output_dir: str) -> Iterator[csv.writer]:
+    """csv writer of the fingerprints.csv of output_dir, the rows go to a temporary file that only replaces
+    fingerprints.csv once all rows are written, e.g., not if the scanner output is truncated"""
+    fp_file = os.path.join(output_dir, 'fingerprints.csv')
+    tmp_file = f'{fp_file}.tmp'
+    try:
+        with pathlib.Path(tmp_file).open(mode='w') as f_out:
+            writer = csv.writer(f_out)
+            writer.writerow(FINGERPRINT_HEADER)
+            yield writer
+        os.replace(tmp_file, fp_file)
+    except BaseException:
+        pathlib.Path(tmp_file).unlink(missing_ok=True)
+        raise
+
+
+def sslyze_fingerprint_row(server_scan_results: dict) -> list:
+    location = server_scan_results.get('server_location')
+
+    scan_result = fingerprint.project_sslyze(server_scan_results.get('scan_result'))
+    extra_sections = {'protocols': fingerprint.sslyze_protocols(scan_result)} if scan_result is not None else None
+    fp_hashed, fp, sections = fingerprint.canonical_fingerprint(scan_result, fingerprint.sslyze_section, extra_sections)
+
+    return [location['ip_address'], location['port'], location['hostname'], fp_hashed, fp,
+            *(sections[name] for name in fingerprint.SECTIONS)]
+
+
+def testssl(testssl_bin: str, input_file: str, output_dir: str, timeout: float = 7200):
     new_input = f'{output_dir}.input'
     pathlib.Path(output_dir).mkdir(exist_ok=True, parents=True)
     output_file = os.path.join(output_dir, f'testssl.json')
 
+    targets = 0
     with pathlib.Path(new_input).open(mode='w') as f:
         with pathlib.Path(input_file).open() as f2:
             for row in csv.reader(f2):
+                targets += 1
                 ip = row[0]
                 port = 443
                 # Currently not supporting ipv6 + port
@@ -159,16 +279,18 @@ def testssl(testssl_bin: str, input_file: str, output_dir: str):
                     ip = splits[0]
                     if len(splits) > 1:
                         port = splits[1]
-                server_name = 'example.com'
+                server_name = TESTSSL_DEFAULT_SNI
                 if len(row) > 1:
                     server_name = row[1]
                 add_6 = ''
                 if validators.ipv6(ip):
                     add_6 = '-6'
                 f.write(
-                    f'-e -s -f -p -P -S -q -g --connect-timeout 15 --openssl-timeout 15 --nodns none {add_6} --ip {ip} {server_name}:{port}' + os.linesep)
+                    f'{TESTSSL_FLAGS} {add_6} --ip {ip} {server_name}:{port}' + os.linesep)
 
-    subprocess.check_output([testssl_bin, '--jsonfile', output_file, '--parallel', '--file', new_input], timeout=7200)
+    runner.run([testssl_bin, '--jsonfile', output_file, '--parallel', '--file', new_input], stdout_log(output_dir),
+               timeout=timeout, progress_pattern=runner.TESTSSL_PROGRESS,
+               progress=runner.ProgressLogger(output_dir, targets))
 
 
 def is_bad_testssl_id(id: str) -> bool:
@@ -182,32 +304,70 @@ def is_bad_testssl_id(id: str) -> bool:
     return False
 
 
-def generate_testssl_fingerprints(output_dir: str):
+def generate_testssl_fingerprints(output_dir: str, streaming: bool = True, max_open_targets: int = 64) -> int:
+    """Write fingerprints.csv for a testssl.json and return the number of targets.
+
+    testssl.sh writes the findings of a target consecutively, so streaming keeps only the last max_open_targets
+    targets in memory and writes a row as soon as a target is evicted. A target whose findings are further apart
+    than that ends up in more than one row, with a warning unless more than MAX_EVICTED_TARGETS other targets were
+    evicted in between.
+    """
     output_file = os.path.join(output_dir, f'testssl.json')
-    fp_file = os.path.join(output_dir, f'fingerprints.csv')
 
-    result = dict()
     with codecs.open(output_file, errors='ignore') as f:
-        testssl_data = json.load(f, strict=False)
-        for entry in testssl_data:
-            target = f'{entry.get("ip")}/{entry.get("port")}'
-            id = entry.get('id')
-            if is_bad_testssl_id(id):
-                continue
-            finding: str = entry.get('finding')
-            r = result.get(target)
-            if r is None:
-                r = dict()
-            r[id] = finding
+        if streaming:
+            entries = json_stream.iter_array(f, strict=False)
+        else:
+            entries = json.load(f, strict=False)
+
+        with fingerprints_writer(output_dir) as writer:
+            targets = 0
+            for target, r in group_testssl_findings(entries, max_open_targets if streaming else None):
+                row = testssl_fingerprint_row(target, r)
+                if row is not None:
+                    writer.writerow(row)
+                    targets += 1
+    return targets
+
+
+def group_testssl_findings(entries: Iterable[dict], max_open_targets: Optional[int]) -> Iterator[Tuple[str, dict]]:
+    """Group testssl.sh findings by target, max_open_targets=None keeps every target until the input is exhausted.
+
+    Findings of a target that was already yielded start a second group of that target. This is logged as a warning
+    if the target is one of the last MAX_EVICTED_TARGETS yielded ones, older ones are forgotten to keep the memory
+    flat and only show up as duplicate targets in the output.
+    """
+    result = OrderedDict()
+    evicted = OrderedDict()
+    for entry in entries:
+        target = f'{entry.get("ip")}/{entry.get("port")}'
+        id = entry.get('id')
+        if is_bad_testssl_id(id):
+            continue
+        finding: str = entry.get('finding')
+        r = result.get(target)
+        if r is None:
+            if evicted.pop(target, False):
+                logging.warning(f'Findings of {target} continue after more than {max_open_targets} other targets, '
+                                f'its fingerprint is split into several rows')
+            r = dict()
             result[target] = r
-
-    with pathlib.Path(fp_file).open(mode='w') as f:
-        writer = csv.writer(f)
-        writer.writerow(['ip', 'port', 'server_name', 'fingerprint', 'fingerprint_raw'])
-        for target, r in result.items():
-            fp = json.dumps(r, sort_keys=True)
-            fp_hash = hashlib.sha256(fp.encode()).hexdigest()
-            server_name, ip, port = target.split('/')
-            ip = ip.replace('[', '').replace(']', '')
-            if ip != '':
-                writer.writerow([ip, port, server_name, fp_hash, fp])
+            if max_open_targets is not None and len(result) > max_open_targets:
+                evicted_target, evicted_r = result.popitem(last=False)
+                evicted[evicted_target] = True
+                if len(evicted) > MAX_EVICTED_TARGETS:
+                    evicted.popitem(last=False)
+                yield evicted_target, evicted_r
+        else:
+            result.move_to_end(target)
+        r[id] = finding
+    yield from result.items()
+
+
+def testssl_fingerprint_row(target: str, r: dict) -> Optional[list]:
+    server_name, ip, port = target.split('/')
+    ip = ip.replace('[', '').replace(']', '')
+    if ip != '':
+        fp_hash, fp, sections = fingerprint.canonical_fingerprint(r, fingerprint.testssl_section)
+        return [ip, port, server_name, fp_hash, fp, *(sections[name] for name in fingerprint.SECTIONS)]
+    return None
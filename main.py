@@ -1,27 +1,35 @@
 #!/usr/bin/env python3
 
-import itertools
+import csv
+import hashlib
+import json
 import logging
 import os
 import shutil
 import time
-from functools import reduce
+from contextlib import contextmanager
+from functools import partial
 from multiprocessing import Pool
 from pathlib import Path
-from typing import Iterator, Optional, Tuple, List
+from typing import Iterator, Optional, Tuple, List, Dict
 
 import click
-import docker as docker_conn
-from docker import DockerClient
 
 import external.docker as docker
 import external.subprocesses as subprocesses
 import tls_configs.apache as apache
 import tls_configs.nginx as nginx
-from tls_configs.test_case import create_test_cases
-from tls_configs.tls_config import generate_configs, TLSConfig
+import pipeline.fingerprint_store as fingerprint_store
+import pipeline.result_cache as result_cache
+import pipeline.telemetry as telemetry
+from pipeline.journal import RunJournal, JOURNAL_FILE
+from pipeline.scheduler import PhaseScheduler
+from pipeline.sharding import ShardedExecutor
+from tls_configs.test_case import create_test_cases, TestCase
+from tls_configs.tls_config import ConfigSpace, TLSConfig, config_hash
 
 CURRENT_DIR = Path(__file__).parent.absolute()
+WEBSERVERS = ['nginx', 'apache']
 
 
 @click.group()
@@ -37,35 +45,101 @@ def main():
 @click.option('--debug-dir', type=click.Path(file_okay=False))
 @click.option('--chunk-size', type=int, default=100)
 @click.option('--capture-chs', type=bool, default=True)
+@click.option('--pooled', is_flag=True, help='Keep the containers running and swap configs with a graceful reload')
+@click.option('--pack', is_flag=True,
+              help='Serve a whole chunk from as few containers as possible, each config on its own port')
+@click.option('--max-parallel-phases', type=int, default=1, help='Scanner phases that may run at the same time')
+@click.option('--dry-run', is_flag=True, help='Print the schedule of the phases of a chunk without scanning')
+@click.option('--resume', is_flag=True, help='Skip the units that the journal of a previous run lists as completed')
+@click.option('--dedup/--no-dedup', default=True, help='Scan configs with the same effective TLS parameters only once')
+@click.option('--shard', type=str, default='0/1', callback=lambda ctx, param, value: parse_shard(value),
+              help='i/N: only scan every N-th chunk of each test case starting with chunk i')
+@click.option('--verbose', '-v', is_flag=True, help='Log the progress of the phases and scanners')
 def local_scan(config_dir: str, output_dir: str, debug_dir: Optional[str], goscanner_bin: str, testssl_bin: str,
-         chunk_size: int, capture_chs: bool):
-    logging.basicConfig(level=logging.WARNING)
+         chunk_size: int, capture_chs: bool, pooled: bool, pack: bool, max_parallel_phases: int, dry_run: bool,
+         resume: bool, dedup: bool, shard: Tuple[int, int], verbose: bool):
+    logging.basicConfig(level=logging.INFO if verbose else logging.WARNING)
+    if pooled and pack:
+        raise click.UsageError('--pooled and --pack cannot be combined')
+    if pack and chunk_size > docker.START_AT_PORT - docker.PACKED_CONTAINER_PORT:
+        raise click.UsageError(f'--pack supports chunks of up to {docker.START_AT_PORT - docker.PACKED_CONTAINER_PORT} '
+                               f'configs')
+    if dry_run:
+        ports = [docker.START_AT_PORT + i for i in range(chunk_size)]
+        click.echo(docker_scan_schedule(0, ports, os.path.join(output_dir, '<test case>', '<webserver>'), goscanner_bin,
+                                        testssl_bin, capture_chs, max_parallel_phases).format_schedule())
+        return
     test_cases = create_test_cases(output_dir)
-    for test_case in test_cases:
-        # Create config Permutations (power set)
-        configurations = generate_configs(test_case)
-        for i, chunk in enumerate(chunker(configurations, chunk_size)):
-            # Clear old configs
-            shutil.rmtree(config_dir, ignore_errors=True)
-            os.mkdir(config_dir)
-
-            for webserver in ['nginx', 'apache']:
-                # Save webserver configurations on disk
-                config_names = list(create_webserver_configs(webserver, i, config_dir, chunk))
-
-                containers = []
+    journal = RunJournal(output_dir, resume)
+    run = telemetry.start(output_dir)
+    trace_dir = output_dir
+    manager = docker.ContainerManager()
+    pools = {webserver: docker.WarmContainerPool(manager, webserver, config_dir) for webserver in WEBSERVERS} if pooled else {}
+    scanned = dict()
+    Path(config_dir).mkdir(parents=True, exist_ok=True)
+    try:
+        for test_case in test_cases:
+            # Create config Permutations (power set)
+            space = ConfigSpace(test_case)
+            indices = plan_test_case(test_case, space, chunk_size, scanned, dedup)
+            for i, chunk_indices in enumerate(chunker(indices, chunk_size)):
+                # Every shard plans the whole test case, so the iterations and ports are the same on all hosts
+                if i % shard[1] != shard[0]:
+                    continue
+                chunk = [space[k] for k in chunk_indices]
+                for webserver in WEBSERVERS:
+                    output_dir = os.path.join(test_case.get_output_dir(), webserver)
+                    unit_prefix = f'{test_case.name}/{webserver}/{i}/'
+                    if docker_scan_completed(journal, unit_prefix, i, len(chunk), output_dir, goscanner_bin,
+                                             testssl_bin, capture_chs):
+                        logging.info(f'Skipping {unit_prefix}, all scans are already completed')
+                        continue
+                    mode = 'pooled' if pooled else 'packed' if pack else 'fresh'
+                    timing = ChunkTiming(test_case.name, webserver, i, mode, len(chunk), unit_prefix)
+
+                    if pooled:
+                        with timing.measure('setup'):
+                            ports = pools[webserver].load([render_webserver_config(webserver, c) for c in chunk])
+                        with timing.measure('scan'):
+                            do_docker_scan(i, ports, output_dir, debug_dir, goscanner_bin, testssl_bin, capture_chs,
+                                           max_parallel_phases, journal, unit_prefix)
+                        timing.write(test_case.get_output_dir())
+                        continue
+
+                    # Save webserver configurations on disk
+                    if pack:
+                        packs = list(create_packed_webserver_configs(webserver, config_dir, chunk))
+                        config_names = [name for name, _ in packs]
+                    else:
+                        config_names = list(create_webserver_configs(webserver, config_dir, chunk))
+
+                    containers = []
 
-                output_dir = os.path.join(test_case.get_output_dir(), webserver)
-
-                try:
-                    # Start Webservers
-                    containers, ports = start_webservers(config_names)
+                    try:
+                        # Start Webservers
+                        with timing.measure('setup'):
+                            if pack:
+                                containers, ports = start_packed_webservers(manager, packs)
+                            else:
+                                containers, ports = start_webservers(manager, config_names)
+
+                        # Scan which each scanner
+                        with timing.measure('scan'):
+                            do_docker_scan(i, ports, output_dir, debug_dir, goscanner_bin, testssl_bin, capture_chs,
+                                           max_parallel_phases, journal, unit_prefix)
+                    finally:
+                        # Stop webservers
+                        with timing.measure('teardown'):
+                            stop_webservers(manager, containers, config_names, debug_dir)
+                    timing.write(test_case.get_output_dir())
+    finally:
+        for pool in pools.values():
+            pool.close(debug_dir)
+        if pooled:
+            manager.prune()
+        manager.close()
+        click.echo(telemetry.summary(telemetry.read_trace(trace_dir, run)))
 
-                    # Scan which each scanner
-                    do_docker_scan(i, ports, output_dir, debug_dir, goscanner_bin, testssl_bin, capture_chs)
-                finally:
-                    # Stop webservers
-                    stop_webservers(containers, config_names, debug_dir)
 
 @main.command()
 @click.option('--input-file', type=click.Path(file_okay=True, exists=True, dir_okay=False), required=True)
@@ -74,86 +148,418 @@ def local_scan(config_dir: str, output_dir: str, debug_dir: Optional[str], gosca
 @click.option('--testssl-bin', type=click.Path(dir_okay=False, exists=True), required=True)
 @click.option('--interface', type=str, required=False, default='any')
 @click.option('--capture-chs', type=bool, default=True)
-def remote_scan(input_file: str, output_dir: str, goscanner_bin: str, testssl_bin: str, capture_chs: bool, interface: str):
-    Path(output_dir).mkdir(parents=True, exist_ok=True)
-    with Pool() as p:
-        async_jobs = []
-        # Active TLS fingerprinting
-        with CaptureClientHellos(capture_chs, [443], os.path.join(output_dir, 'atsf_chs.csv'), interface=interface):
-            fixed_dir = os.path.join(output_dir, 'atsf')
-            subprocesses.goscanner_normal(goscanner_bin, input_file, fixed_dir)
-            async_jobs.append(p.apply_async(subprocesses.generate_goscanner_fps, (goscanner_bin, fixed_dir)))
-        # 2x DeepTLS
-        with CaptureClientHellos(capture_chs, [443], os.path.join(output_dir, 'dissectls_10_chs.csv'), interface=interface):
-            subprocesses.goscanner_deep_tls(goscanner_bin, input_file, 10, os.path.join(output_dir, 'dissectls_10'))
-
-        with CaptureClientHellos(capture_chs, [443], os.path.join(output_dir, 'dissectls_chs.csv'), interface=interface):
-            subprocesses.goscanner_deep_tls(goscanner_bin, input_file, 100, os.path.join(output_dir, 'dissectls'))
-        # JARM
-        with CaptureClientHellos(capture_chs, [443], os.path.join(output_dir, 'jarm_chs.csv'), interface=interface):
-            subprocesses.goscanner_jarm(goscanner_bin, input_file, os.path.join(output_dir, 'jarm'))
-
-        # testssl.sh
+@click.option('--max-parallel-phases', type=int, default=1, help='Scanner phases that may run at the same time')
+@click.option('--dry-run', is_flag=True, help='Print the schedule of the phases without scanning')
+@click.option('--shards-parallel', type=int, default=4, help='testssl.sh/SSLyze shards that run at the same time')
+@click.option('--shard-timeout', type=float, default=7200)
+@click.option('--resume', is_flag=True, help='Skip the phases that the journal of a previous run lists as completed')
+@click.option('--cache', 'cache_file', type=click.Path(dir_okay=False),
+              help='sqlite file of testssl.sh/SSLyze results, targets with an unchanged JARM fingerprint are not scanned')
+@click.option('--cache-ttl', type=float, default=7, help='Days after which a cached result is scanned again')
+@click.option('--verbose', '-v', is_flag=True, help='Log the progress of the phases and scanners')
+def remote_scan(input_file: str, output_dir: str, goscanner_bin: str, testssl_bin: str, capture_chs: bool, interface: str,
+                max_parallel_phases: int, dry_run: bool, shards_parallel: int, shard_timeout: float, resume: bool,
+                cache_file: Optional[str], cache_ttl: float, verbose: bool):
+    logging.basicConfig(level=logging.INFO if verbose else logging.WARNING)
+    if dry_run:
+        # Only reads the journal, without resume the run would start over
+        journal = RunJournal(output_dir, True) if resume else None
+    else:
+        journal = RunJournal(output_dir, resume)
+    scheduler = remote_scan_schedule(input_file, output_dir, goscanner_bin, testssl_bin, capture_chs, interface,
+                                     max_parallel_phases, shards_parallel, shard_timeout, journal, cache_file,
+                                     cache_ttl * 24 * 3600)
+    if dry_run:
+        click.echo(scheduler.format_schedule())
+        return
+    run = telemetry.start(output_dir)
+    try:
+        scheduler.run()
+    finally:
+        click.echo(telemetry.summary(telemetry.read_trace(output_dir, run)))
+
+
+REMOTE_CHUNK_SIZE = 200
+
+
+def remote_scan_schedule(input_file: str, output_dir: str, goscanner_bin: str, testssl_bin: str, capture_chs: bool,
+                         interface: str, max_parallel: int, shards_parallel: int = 4, shard_timeout: float = 7200,
+                         journal: Optional[RunJournal] = None, cache_file: Optional[str] = None,
+                         cache_ttl: float = 0) -> PhaseScheduler:
+    scheduler = PhaseScheduler(max_parallel, journal=journal, unit_prefix='remote/')
+    with Path(input_file).open() as f:
+        targets = sum(1 for line in f if line.strip() != '')
+
+    def phase(name: str, chs_name: str, out_dir: str, func, *args, deps=()):
+        add_phase(scheduler, name, capture_chs, [443], os.path.join(output_dir, chs_name), interface, out_dir, func,
+                  *args, deps=deps, targets=targets)
+
+    # Active TLS fingerprinting
+    fixed_dir = os.path.join(output_dir, 'atsf')
+    phase('atsf', 'atsf_chs.csv', fixed_dir, subprocesses.goscanner_normal, goscanner_bin, input_file, fixed_dir)
+    scheduler.add('atsf-fingerprints', subprocesses.generate_goscanner_fps, goscanner_bin, fixed_dir,
+                  deps=['atsf'], post_process=True, output=fixed_dir)
+    # 2x DeepTLS
+    dissectls_10_dir = os.path.join(output_dir, 'dissectls_10')
+    phase('dissectls_10', 'dissectls_10_chs.csv', dissectls_10_dir, subprocesses.goscanner_deep_tls, goscanner_bin,
+          input_file, 10, dissectls_10_dir)
+    dissectls_dir = os.path.join(output_dir, 'dissectls')
+    phase('dissectls', 'dissectls_chs.csv', dissectls_dir, subprocesses.goscanner_deep_tls, goscanner_bin,
+          input_file, 100, dissectls_dir)
+    # JARM
+    jarm_dir = os.path.join(output_dir, 'jarm')
+    phase('jarm', 'jarm_chs.csv', jarm_dir, subprocesses.goscanner_jarm, goscanner_bin, input_file, jarm_dir)
+
+    # With a cache, the JARM fingerprints decide which targets testssl.sh and SSLyze scan
+    cache = (cache_file, cache_ttl, jarm_dir) if cache_file is not None else None
+    cache_deps = ['jarm'] if cache_file is not None else []
+    # testssl.sh
+    testssl_dir = os.path.join(output_dir, 'testssl')
+    phase('testssl', 'testssl_chs.csv', testssl_dir, run_sharded, input_file, partial(subprocesses.testssl, testssl_bin),
+          subprocesses.generate_testssl_fingerprints, testssl_dir, shards_parallel, shard_timeout, cache,
+          deps=cache_deps)
+    # SSLyze
+    sslyze_dir = os.path.join(output_dir, 'sslyze')
+    phase('sslyze', 'sslyze_chs.csv', sslyze_dir, run_sharded, input_file, subprocesses.sslyze,
+          subprocesses.generate_sslyze_fingerprints, sslyze_dir, shards_parallel, shard_timeout, cache,
+          deps=cache_deps)
+    return scheduler
+
+
+# server_name column of the fingerprints.csv row of a target (ip, SNI)
+CACHE_SERVER_NAMES = {
+    'testssl': lambda ip, sni: sni or subprocesses.TESTSSL_DEFAULT_SNI,
+    'sslyze': lambda ip, sni: sni or ip,
+}
+
+
+def scanner_config_hash(scanner: str) -> str:
+    flags = subprocesses.TESTSSL_FLAGS if scanner == 'testssl' else ' '.join(subprocesses.SSLYZE_FLAGS)
+    return result_cache.config_hash(scanner, flags, *subprocesses.FINGERPRINT_HEADER)
+
+
+def run_sharded(input_file: str, scan, post_process, output_dir: str, parallel: int, timeout: float,
+                cache: Optional[Tuple[str, float, str]] = None):
+    """Scan the targets of input_file in shards, cache is the cache file, its TTL, and the JARM output directory"""
+    # Shards of an earlier, incomplete run might be cut differently
+    shutil.rmtree(output_dir, ignore_errors=True)
+    executor = ShardedExecutor(scan, post_process, output_dir, parallel=parallel, initial_size=REMOTE_CHUNK_SIZE,
+                               timeout=timeout)
+    if cache is None:
         with Path(input_file).open() as f:
-            for i, chunk in enumerate(chunker(f, 200)):
-                logging.info(f'Iteration {i} started')
-                iteration_input = os.path.join(output_dir, f'iteration-{i}-input.csv')
-                Path(iteration_input).write_text(reduce(lambda x,y: x+y, chunk))
+            executor.run(f.readlines())
+        return
+    cache_file, cache_ttl, jarm_dir = cache
+    scanner = os.path.basename(output_dir)
+    results = result_cache.ResultCache(cache_file, cache_ttl)
+    try:
+        result_cache.scan_with_cache(results, scanner, scanner_config_hash(scanner), CACHE_SERVER_NAMES[scanner],
+                                     result_cache.read_jarm_probes(jarm_dir), input_file, output_dir, executor.run)
+    finally:
+        results.close()
+
+
+def add_phase(scheduler: PhaseScheduler, name: str, capture_chs: bool, ports: List[int], chs_file: str,
+              interface: str, out_dir: str, func, *args, deps=(), targets: Optional[int] = None,
+              iteration: Optional[int] = None):
+    """Add a scanner phase that holds its output directory and, when capturing, the ports of its capture"""
+    resources = {f'output:{out_dir}'}
+    if capture_chs:
+        # Overlapping captures on the same ports could not tell the Client Hellos of the phases apart
+        resources |= {f'capture:{interface}:{port}' for port in ports}
+    scheduler.add(name, run_phase, capture_chs, ports, chs_file, interface, iteration, targets, func, *args, deps=deps,
+                  resources=resources, output=out_dir)
+
+
+def run_phase(capture_chs: bool, ports: List[int], chs_file: str, interface: str, iteration: Optional[int],
+              targets: Optional[int], func, *args):
+    telemetry.annotate(targets=targets)
+    with CaptureClientHellos(capture_chs, ports, chs_file, interface=interface, iteration=iteration):
+        func(*args)
 
-                with CaptureClientHellos(capture_chs, [443], os.path.join(output_dir, 'testssl_chs.csv'), interface=interface):
-                    testssl_dir = os.path.join(output_dir, 'testssl', f'iteration={i}')
-                    subprocesses.testssl(testssl_bin, iteration_input, testssl_dir)
-                    async_jobs.append(p.apply_async(subprocesses.generate_testssl_fingerprints, [testssl_dir]))
 
-                # SSLyze
-                with CaptureClientHellos(capture_chs, [443], os.path.join(output_dir, 'sslyze_chs.csv'), interface=interface):
-                    sslyze_dir = os.path.join(output_dir, 'sslyze', f'iteration={i}')
-                    subprocesses.sslyze(iteration_input, sslyze_dir)
+@main.command()
+@click.option('--output-dir', type=click.Path(file_okay=False), required=True)
+@click.option('--workers', type=int, default=os.cpu_count())
+@click.option('--force', is_flag=True, help='Regenerate fingerprints that are already up to date')
+def generate_fingerprints(output_dir: str, workers: int, force: bool):
+    logging.basicConfig(level=logging.WARNING)
+    manifest_file = Path(output_dir, FINGERPRINT_MANIFEST)
+    manifest = json.loads(manifest_file.read_text()) if manifest_file.exists() else dict()
+
+    run = telemetry.start(output_dir)
+    jobs = list(find_fingerprint_jobs(output_dir))
+    todo = [job for job in jobs if force or not fingerprints_up_to_date(output_dir, manifest, *job)]
+
+    start = time.monotonic()
+    last_progress = start
+    total_targets = 0
+    failed = 0
+    try:
+        with Pool(workers) as p:
+            for i, (tool, iter_dir, raw_stat, targets) in enumerate(p.imap_unordered(generate_iteration_fingerprints, todo)):
+                if targets is None:
+                    failed += 1
+                else:
+                    total_targets += targets
+                    manifest[os.path.relpath(iter_dir, output_dir)] = {
+                        'raw_size': raw_stat[0], 'raw_mtime_ns': raw_stat[1], 'targets': targets,
+                        'format_version': subprocesses.FINGERPRINT_FORMAT_VERSION}
+                if time.monotonic() - last_progress >= PROGRESS_INTERVAL:
+                    last_progress = time.monotonic()
+                    click.echo(f'{i + 1}/{len(todo)} iterations done, {total_targets} targets, {failed} failed',
+                               err=True)
+                if i % 50 == 49:
+                    write_manifest(manifest_file, manifest)
+    finally:
+        write_manifest(manifest_file, manifest)
+
+    duration = time.monotonic() - start
+    click.echo(f'{len(todo) - failed} iterations processed, {len(jobs) - len(todo)} up to date, {failed} failed')
+    click.echo(f'{total_targets} targets in {duration:.1f}s ({total_targets / max(duration, 1e-9):.1f} targets/s)')
+    click.echo(telemetry.summary(telemetry.read_trace(output_dir, run)))
+
+
+FINGERPRINT_MANIFEST = '.fingerprints-manifest.json'
+# Seconds between the progress lines of generate-fingerprints
+PROGRESS_INTERVAL = 10
+RAW_OUTPUT_FILES = {'sslyze': 'sslyze.json', 'testssl': 'testssl.json'}
+
+
+def find_fingerprint_jobs(output_dir: str) -> Iterator[Tuple[str, str]]:
+    for dirpath, dirnames, filenames in os.walk(output_dir):
+        tool = os.path.basename(dirpath)
+        if tool in RAW_OUTPUT_FILES:
+            for iteration in dirnames:
+                iter_dir = os.path.join(dirpath, iteration)
+                # iteration=cached of a remote scan with a result cache has no raw output
+                if Path(iter_dir, RAW_OUTPUT_FILES[tool]).is_file():
+                    yield tool, iter_dir
+
+
+def fingerprints_up_to_date(output_dir: str, manifest: dict, tool: str, iter_dir: str) -> bool:
+    """Fingerprints are up to date if they are newer than the raw output that was recorded in the manifest and have
+    the current format"""
+    try:
+        raw_stat = os.stat(os.path.join(iter_dir, RAW_OUTPUT_FILES[tool]))
+        fp_stat = os.stat(os.path.join(iter_dir, 'fingerprints.csv'))
+    except FileNotFoundError:
+        return False
+    entry = manifest.get(os.path.relpath(iter_dir, output_dir))
+    return entry is not None and fp_stat.st_mtime_ns >= raw_stat.st_mtime_ns and \
+        entry['raw_size'] == raw_stat.st_size and entry['raw_mtime_ns'] == raw_stat.st_mtime_ns and \
+        entry.get('format_version') == subprocesses.FINGERPRINT_FORMAT_VERSION
+
+
+def generate_iteration_fingerprints(job: Tuple[str, str]) -> Tuple[str, str, Optional[Tuple[int, int]], Optional[int]]:
+    tool, iter_dir = job
+    try:
+        raw_stat = os.stat(os.path.join(iter_dir, RAW_OUTPUT_FILES[tool]))
+        if tool == 'sslyze':
+            targets = telemetry.traced('sslyze-fingerprints', os.path.join(iter_dir, 'fingerprints.csv'),
+                                       {'unit': iter_dir}, subprocesses.generate_sslyze_fingerprints, iter_dir)
+        elif tool == 'testssl':
+            targets = telemetry.traced('testssl-fingerprints', os.path.join(iter_dir, 'fingerprints.csv'),
+                                       {'unit': iter_dir}, subprocesses.generate_testssl_fingerprints, iter_dir)
+        else:
+            logging.fatal(f'Unknown option {tool}')
+            return tool, iter_dir, None, None
+        return tool, iter_dir, (raw_stat.st_size, raw_stat.st_mtime_ns), targets
+    except Exception as e:
+        logging.error(f'Error during parsing {iter_dir}', exc_info=e)
+        return tool, iter_dir, None, None
+
+
+def write_manifest(manifest_file: Path, manifest: dict):
+    tmp_file = manifest_file.with_name(f'{manifest_file.name}.tmp')
+    tmp_file.write_text(json.dumps(manifest, indent=1, sort_keys=True))
+    os.replace(tmp_file, manifest_file)
+
+
+@main.command()
+@click.option('--output-dir', type=click.Path(file_okay=False, exists=True), required=True)
+@click.option('--store-dir', type=click.Path(file_okay=False), required=True)
+@click.option('--scanner', type=str, multiple=True, help='Only add the fingerprints of these scanners')
+def build_fingerprint_store(output_dir: str, store_dir: str, scanner: Tuple[str]):
+    """Consolidate the fingerprints.csv files into a Parquet dataset (needs pyarrow)"""
+    logging.basicConfig(level=logging.WARNING)
+    try:
+        rows = fingerprint_store.build_store(output_dir, store_dir, list(scanner) if len(scanner) > 0 else None)
+    except ImportError as e:
+        raise click.ClickException(str(e))
+    click.echo(f'{rows} fingerprints written to {store_dir}')
 
-                    async_jobs.append(p.apply_async(subprocesses.generate_sslyze_fingerprints, [sslyze_dir]))
 
-        for job in async_jobs:
-            job.get()
+@main.command()
+@click.option('--output-dir', type=click.Path(file_okay=False, exists=True), required=True)
+@click.option('--store-dir', type=click.Path(file_okay=False, exists=True), required=True)
+@click.option('--scanner', type=str)
+def distinguishing_power(output_dir: str, store_dir: str, scanner: Optional[str]):
+    """Print the distinct fingerprints per distinct config of each scanner, test case, and webserver"""
+    try:
+        result = fingerprint_store.distinguishing_power(store_dir, output_dir, scanner)
+    except ImportError as e:
+        raise click.ClickException(str(e))
+    click.echo(f'{"test case":<24} {"webserver":<10} {"scanner":<14} {"configs":>8} {"fingerprints":>13} {"power":>6}')
+    for row in result.to_pylist():
+        click.echo(f'{row["test_case"]:<24} {row["webserver"]:<10} {row["scanner"]:<14} {row["configs"]:>8} '
+                   f'{row["fingerprints"]:>13} {row["distinguishing_power"]:>6.2f}')
 
 
 @main.command()
 @click.option('--output-dir', type=click.Path(file_okay=False), required=True)
-def generate_fingerprints(output_dir: str):
+@click.argument('shard_dirs', nargs=-1, required=True, type=click.Path(file_okay=False, exists=True))
+def merge_shards(output_dir: str, shard_dirs: Tuple[str]):
+    """Merge the output directories of local-scan --shard runs into output_dir"""
     logging.basicConfig(level=logging.WARNING)
-    for dirpath, dirnames, filenames in os.walk(output_dir):
-        tool = os.path.basename(dirpath)
-        if tool in ['sslyze', 'testssl']:
-            for iteration in dirnames:
-                iter_dir = Path(os.path.join(dirpath, iteration))
-                if iter_dir.is_dir():
-                    try:
-                        if tool == 'sslyze':
-                            subprocesses.generate_sslyze_fingerprints(str(iter_dir))
-                        elif tool == 'testssl':
-                            subprocesses.generate_testssl_fingerprints(str(iter_dir))
-                        else:
-                            logging.fatal(f'Unknown option {tool}')
-                    except Exception as e:
-                        logging.error(f'Error during parsing {iter_dir}', exc_info=e)
+    for shard_dir in shard_dirs:
+        for dirpath, _, names in os.walk(shard_dir):
+            for name in names:
+                relative = os.path.relpath(os.path.join(dirpath, name), shard_dir)
+                merge_shard_file(os.path.join(shard_dir, relative), os.path.join(output_dir, relative))
+
+
+def merge_shard_file(source: str, destination: str):
+    """Copy a file of a shard, the Client Hello counts, timings, and journal of the shards are concatenated.
+
+    The rows of concatenated files carry their iteration, the same rows of two shards are different chunks and are
+    all kept.
+    """
+    if not os.path.exists(destination):
+        Path(destination).parent.mkdir(parents=True, exist_ok=True)
+        shutil.copy2(source, destination)
+        return
+    name = os.path.basename(source)
+    if name.endswith('_chs.csv') or name in ['timings.csv', JOURNAL_FILE, telemetry.TRACE_FILE]:
+        with open(source) as s, open(destination, mode='a') as d:
+            if name == 'timings.csv':
+                s.readline()
+            shutil.copyfileobj(s, d)
+        return
+    with open(source, mode='rb') as s, open(destination, mode='rb') as d:
+        if s.read() == d.read():
+            return
+    logging.warning(f'{destination} differs between the shards, keeping the first one')
+
+
+def render_webserver_config(webserver: str, config: TLSConfig) -> str:
+    if webserver == 'nginx':
+        return nginx.create_nginx_config(config)
+    elif webserver == 'apache':
+        return apache.create_apache_config(config)
+    else:
+        logging.fatal(f'Wrong webserver {webserver}')
+
 
+def create_webserver_configs(webserver: str, config_dir, configurations: Iterator[TLSConfig]) -> Iterator[str]:
+    """Store the rendered configs in config_dir named by their hash, configs that already exist are not rewritten"""
+    for config in configurations:
+        rendered = render_webserver_config(webserver, config)
+        name = os.path.join(config_dir, f'{webserver}_{hashlib.sha256(rendered.encode()).hexdigest()}.conf')
+        if not os.path.exists(name):
+            Path(f'{name}.tmp').write_text(rendered)
+            os.replace(f'{name}.tmp', name)
+        yield name
 
-def create_webserver_configs(webserver: str, iteration: int, config_dir, configurations: Iterator[TLSConfig]) -> Iterator[str]:
+
+PACK_KEYS = {
+    'nginx': nginx.pack_key,
+    'apache': apache.pack_key,
+}
+
+
+def render_packed_webserver_config(webserver: str, configs: List[Tuple[TLSConfig, int]]) -> str:
     if webserver == 'nginx':
-        for i, config in enumerate(configurations):
-            n_config = nginx.create_nginx_config(config)
-            name = os.path.join(config_dir, f'nginx_{iteration}_{i}.conf')
-            Path(name).write_text(n_config)
-            yield name
+        return nginx.create_nginx_packed_config(configs)
     elif webserver == 'apache':
-        for i, config in enumerate(configurations):
-            name = os.path.join(config_dir, f'apache_{iteration}_{i}.conf')
-            a_config = apache.create_apache_config(config)
-            Path(name).write_text(a_config)
-            yield name
+        return apache.create_apache_packed_config(configs)
     else:
         logging.fatal(f'Wrong webserver {webserver}')
 
 
+def create_packed_webserver_configs(webserver: str, config_dir,
+                                    configurations: List[TLSConfig]) -> Iterator[Tuple[str, List[int]]]:
+    """Store the configs of a chunk packed into as few configs as the webserver allows and yield them with their
+    published ports, the k-th config of the chunk is published on START_AT_PORT + k like with a container per config"""
+    groups: Dict[tuple, List[Tuple[TLSConfig, int]]] = dict()
+    for k, config in enumerate(configurations):
+        groups.setdefault(PACK_KEYS[webserver](config), []).append((config, docker.START_AT_PORT + k))
+    for configs in groups.values():
+        rendered = render_packed_webserver_config(webserver, [(config, docker.packed_container_port(port))
+                                                              for config, port in configs])
+        name = os.path.join(config_dir, f'{webserver}_packed_{hashlib.sha256(rendered.encode()).hexdigest()}.conf')
+        if not os.path.exists(name):
+            Path(f'{name}.tmp').write_text(rendered)
+            os.replace(f'{name}.tmp', name)
+        yield name, [port for _, port in configs]
+
+
+def parse_shard(value: str) -> Tuple[int, int]:
+    try:
+        index, count = (int(v) for v in value.split('/'))
+    except ValueError:
+        raise click.BadParameter(f'{value} is not of the form i/N')
+    if count < 1 or not 0 <= index < count:
+        raise click.BadParameter(f'{value} needs 0 <= i < N')
+    return index, count
+
+
+def plan_test_case(test_case: TestCase, space: ConfigSpace, chunk_size: int, scanned: Dict[str, tuple],
+                   dedup: bool) -> List[int]:
+    """Indices of the configs of a test case in space that have to be scanned.
+
+    configs.csv of the test case links every config to the test case, iteration, and port at which it or an
+    equivalent config (see config_hash) is scanned. scanned carries the configs of earlier test cases.
+    """
+    to_scan = []
+    rows = []
+    for i, config in enumerate(space):
+        h = config_hash(config)
+        if dedup and h in scanned:
+            location = scanned[h]
+        else:
+            location = (test_case.name, len(to_scan) // chunk_size, docker.START_AT_PORT + len(to_scan) % chunk_size)
+            scanned.setdefault(h, location)
+            to_scan.append(i)
+        rows.append((i, h, *location))
+
+    Path(test_case.get_output_dir()).mkdir(parents=True, exist_ok=True)
+    with Path(test_case.get_output_dir(), 'configs.csv').open(mode='w') as f:
+        writer = csv.writer(f)
+        writer.writerow(['config_index', 'config_hash', 'test_case', 'iteration', 'port'])
+        writer.writerows(rows)
+    logging.info(f'{test_case.name}: scanning {len(to_scan)} of {len(rows)} configs')
+    return to_scan
+
+
+class ChunkTiming(object):
+    """Wall-clock time of the setup, scan and teardown of one chunk, appended to timings.csv of the test case"""
+
+    def __init__(self, test_case: str, webserver: str, iteration: int, mode: str, configs: int, unit: str = ''):
+        self.row = {'test_case': test_case, 'webserver': webserver, 'iteration': iteration, 'mode': mode,
+                    'configs': configs, 'setup': 0.0, 'scan': 0.0, 'teardown': 0.0}
+        self.unit = unit
+
+    @contextmanager
+    def measure(self, step: str):
+        start = time.monotonic()
+        try:
+            with telemetry.span(f'chunk-{step}', unit=self.unit, targets=self.row['configs']):
+                yield
+        finally:
+            self.row[step] += time.monotonic() - start
+
+    def write(self, output_dir: str):
+        timings_file = Path(output_dir, 'timings.csv')
+        new_file = not timings_file.exists()
+        timings_file.parent.mkdir(parents=True, exist_ok=True)
+        with timings_file.open(mode='a') as f:
+            writer = csv.DictWriter(f, fieldnames=list(self.row))
+            if new_file:
+                writer.writeheader()
+            writer.writerow(self.row)
+
+
 def chunker(seq, size):
     chunk = []
     for s in seq:
@@ -161,95 +567,141 @@ def chunker(seq, size):
         if len(chunk) == size:
             yield chunk
             chunk = []
-    yield chunk
+    if len(chunk) > 0:
+        yield chunk
 
 
-def start_webservers(config_names: List[str]) -> Tuple[list, list]:
-    with Pool() as p:
-        container_ports = p.starmap(docker.start_container, enumerate(config_names))
-        containers, ports = zip(*container_ports)
-        return containers, ports
+def start_webservers(manager: docker.ContainerManager, config_names: List[str]) -> Tuple[list, list]:
+    container_ports = manager.start_many(config_names)
+    containers, ports = zip(*container_ports)
+    return containers, ports
 
 
-def stop_webservers(containers: List[str], config_names, debug_dir: Optional[str]):
-    with Pool() as p:
-        if debug_dir is not None:
-            # Debugging
-            Path(debug_dir).mkdir(exist_ok=True)
-            p.starmap(docker.save_logs, zip(itertools.cycle([debug_dir]), config_names, containers))
+def start_packed_webservers(manager: docker.ContainerManager,
+                            packs: List[Tuple[str, List[int]]]) -> Tuple[list, list]:
+    """Start a container per packed config, the ports are in the order of the configs of the chunk"""
+    started = manager.start_packed_many(packs)
+    containers = [container for container, _ in started]
+    ports = sorted(port for _, pack_ports in started for port in pack_ports)
+    return containers, ports
 
-        # 4. shutdown
-        p.map(docker.stop_container, containers)
 
-        client: DockerClient = docker_conn.from_env()
-        client.containers.prune()
+def stop_webservers(manager: docker.ContainerManager, containers: List[str], config_names, debug_dir: Optional[str]):
+    if debug_dir is not None:
+        # Debugging
+        manager.save_logs_many(debug_dir, config_names, containers)
+
+    # 4. shutdown
+    manager.stop_many(containers)
+    manager.prune()
 
 
 def do_docker_scan(iteration: int, ports: List[int], output_dir: str, debug_dir: Optional[str], goscanner_bin: str,
-                   testssl_bin: str, capture_chs: bool):
+                   testssl_bin: str, capture_chs: bool, max_parallel: int = 1, journal: Optional[RunJournal] = None,
+                   unit_prefix: str = ''):
     # Scan with scanners
     Path(output_dir).mkdir(exist_ok=True, parents=True)
     input_file = os.path.join(output_dir, 'input.csv')
 
     Path(input_file).write_text(os.linesep.join((f'127.0.0.1:{p}' for p in ports)))
 
-    with Pool() as p:
-        async_jobs = []
-
-        # Active TLS fingerprinting
-        with CaptureClientHellos(capture_chs, ports, os.path.join(output_dir, 'fixed_chs.csv')):
-            fixed_dir = os.path.join(output_dir, 'dissectls', f'iteration={iteration}')
-            subprocesses.goscanner_normal(goscanner_bin, input_file, fixed_dir)
-
-            async_jobs.append(p.apply_async(subprocesses.generate_goscanner_fps, (goscanner_bin, fixed_dir)))
-        # 2x DeepTLS
-        with CaptureClientHellos(capture_chs, ports, os.path.join(output_dir, 'dissectls_10_chs.csv')):
-            subprocesses.goscanner_deep_tls(goscanner_bin, input_file, 10,
-                                      os.path.join(output_dir, 'dissectls_10', f'iteration={iteration}'))
-        with CaptureClientHellos(capture_chs, ports, os.path.join(output_dir, 'dissectls_chs.csv')):
-            subprocesses.goscanner_deep_tls(goscanner_bin, input_file, 100,
-                                      os.path.join(output_dir, 'dissectls', f'iteration={iteration}'))
-        # JARM
-        with CaptureClientHellos(capture_chs, ports, os.path.join(output_dir, 'jarm_chs.csv')):
-            subprocesses.goscanner_jarm(goscanner_bin, input_file, os.path.join(output_dir, 'jarm', f'iteration={iteration}'))
-
-        # testssl.sh
-        with CaptureClientHellos(capture_chs, ports, os.path.join(output_dir, 'testssl_chs.csv')):
-            testssl_dir = os.path.join(output_dir, 'testssl', f'iteration={iteration}')
-            subprocesses.testssl(testssl_bin, input_file, testssl_dir)
-            async_jobs.append(p.apply_async(subprocesses.generate_testssl_fingerprints, [testssl_dir]))
-
-        # SSLyze
-        with CaptureClientHellos(capture_chs, ports, os.path.join(output_dir, 'sslyze_chs.csv')):
-            sslyze_dir = os.path.join(output_dir, 'sslyze', f'iteration={iteration}')
-            subprocesses.sslyze(input_file, sslyze_dir)
-            async_jobs.append(p.apply_async(subprocesses.generate_sslyze_fingerprints, [sslyze_dir]))
-
-        for job in async_jobs:
-            job.get()
+    docker_scan_schedule(iteration, ports, output_dir, goscanner_bin, testssl_bin, capture_chs, max_parallel, journal,
+                         unit_prefix).run()
+
+
+def docker_scan_completed(journal: RunJournal, unit_prefix: str, iteration: int, configs: int, output_dir: str,
+                          goscanner_bin: str, testssl_bin: str, capture_chs: bool) -> bool:
+    """Whether all phases of a chunk are completed, then its containers do not have to be started at all"""
+    ports = [docker.START_AT_PORT + i for i in range(configs)]
+    scheduler = docker_scan_schedule(iteration, ports, output_dir, goscanner_bin, testssl_bin, capture_chs, 1, journal,
+                                     unit_prefix)
+    return len(scheduler.completed()) == len(scheduler.steps)
+
+
+def docker_scan_schedule(iteration: int, ports: List[int], output_dir: str, goscanner_bin: str, testssl_bin: str,
+                         capture_chs: bool, max_parallel: int, journal: Optional[RunJournal] = None,
+                         unit_prefix: str = '') -> PhaseScheduler:
+    input_file = os.path.join(output_dir, 'input.csv')
+    scheduler = PhaseScheduler(max_parallel, journal=journal, unit_prefix=unit_prefix)
+
+    def phase(name: str, chs_name: str, out_dir: str, func, *args):
+        add_phase(scheduler, name, capture_chs, ports, os.path.join(output_dir, chs_name), 'any', out_dir, func, *args,
+                  targets=len(ports), iteration=iteration)
+
+    # Active TLS fingerprinting
+    fixed_dir = os.path.join(output_dir, 'atsf', f'iteration={iteration}')
+    phase('atsf', 'fixed_chs.csv', fixed_dir, subprocesses.goscanner_normal, goscanner_bin, input_file, fixed_dir)
+    scheduler.add('atsf-fingerprints', subprocesses.generate_goscanner_fps, goscanner_bin, fixed_dir,
+                  deps=['atsf'], post_process=True, output=fixed_dir)
+    # 2x DeepTLS
+    dissectls_10_dir = os.path.join(output_dir, 'dissectls_10', f'iteration={iteration}')
+    phase('dissectls_10', 'dissectls_10_chs.csv', dissectls_10_dir, subprocesses.goscanner_deep_tls, goscanner_bin,
+          input_file, 10, dissectls_10_dir)
+    dissectls_dir = os.path.join(output_dir, 'dissectls', f'iteration={iteration}')
+    phase('dissectls', 'dissectls_chs.csv', dissectls_dir, subprocesses.goscanner_deep_tls, goscanner_bin,
+          input_file, 100, dissectls_dir)
+    # JARM
+    jarm_dir = os.path.join(output_dir, 'jarm', f'iteration={iteration}')
+    phase('jarm', 'jarm_chs.csv', jarm_dir, subprocesses.goscanner_jarm, goscanner_bin, input_file, jarm_dir)
+
+    # testssl.sh
+    testssl_dir = os.path.join(output_dir, 'testssl', f'iteration={iteration}')
+    phase('testssl', 'testssl_chs.csv', testssl_dir, subprocesses.testssl, testssl_bin, input_file, testssl_dir)
+    scheduler.add('testssl-fingerprints', subprocesses.generate_testssl_fingerprints, testssl_dir,
+                  deps=['testssl'], post_process=True, output=os.path.join(testssl_dir, 'fingerprints.csv'))
+
+    # SSLyze
+    sslyze_dir = os.path.join(output_dir, 'sslyze', f'iteration={iteration}')
+    phase('sslyze', 'sslyze_chs.csv', sslyze_dir, subprocesses.sslyze, input_file, sslyze_dir)
+    scheduler.add('sslyze-fingerprints', subprocesses.generate_sslyze_fingerprints, sslyze_dir,
+                  deps=['sslyze'], post_process=True, output=os.path.join(sslyze_dir, 'fingerprints.csv'))
+    return scheduler
 
 
 class CaptureClientHellos(object):
-    def __init__(self, capture_chs: bool, ports: Optional[Iterator[int]], filename: str, interface: str = 'any'):
-        self.ports = ports
+    """Counts the Client Hellos of a scanner phase with a single tcpdump over all ports.
+
+    Appends one row per port (Client Hellos, received, dropped, port, iteration) to filename, one row without a port
+    if ports is None, and no rows if tcpdump failed. received and dropped are the packets that the tcpdump of the
+    whole phase reported as received by filter and dropped by kernel, the same on every row of the phase. iteration
+    is the chunk of a local scan, so that the rows of merged shards can be told apart.
+    """
+
+    def __init__(self, capture_chs: bool, ports: Optional[Iterator[int]], filename: str, interface: str = 'any',
+                 iteration: Optional[int] = None):
+        self.ports = list(ports) if ports is not None else None
         self.capture_chs = capture_chs
-        self.subprocesses: list
+        self.capture: Optional[subprocesses.ClientHelloCapture] = None
         self.filename = filename
         self.interface = interface
+        self.iteration = iteration if iteration is not None else ''
 
     def __enter__(self):
         if self.capture_chs:
-            if self.ports is None:
-                self.ports = [None]
-            self.subprocesses = list(itertools.starmap(subprocesses.tcpdump_start, (self.ports, self.interface)))
-            time.sleep(2)
+            self.capture = subprocesses.ClientHelloCapture(self.ports, self.interface)
+            self.capture.start()
 
     def __exit__(self, type, value, traceback):
         if self.capture_chs:
-            time.sleep(2)
-            out = map(subprocesses.tcpdump_stop, self.subprocesses)
+            counts = self.capture.stop()
+            chs = sum(counts.values()) if counts is not None else None
+            telemetry.annotate(chs=chs)
+            span = telemetry.current()
+            telemetry.emit_process('tcpdump', self.capture.wall, self.capture.rusage, chs=chs,
+                                   unit=span.record.get('unit') if span is not None else None,
+                                   status='ok' if counts is not None else 'capture-failed')
+            if counts is None:
+                # No rows rather than zero counts that look like ports without Client Hellos
+                logging.error(f'Client Hello capture failed, not writing counts to {self.filename}')
+                return
+            received = self.capture.stats.get('received by filter', '')
+            dropped = self.capture.stats.get('dropped by kernel', '')
+            if self.ports is None:
+                rows = [(sum(counts.values()), received, dropped, '', self.iteration)]
+            else:
+                rows = [(counts[port], received, dropped, port, self.iteration) for port in self.ports]
             with Path(self.filename).open(mode='a') as f:
-                f.writelines((','.join(line) + os.linesep for line in out if line[0] is not None))
+                f.writelines((','.join(map(str, row)) + os.linesep for row in rows))
 
 
 if __name__ == "__main__":
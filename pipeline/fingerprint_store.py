@@ -0,0 +1,159 @@
+import logging
+import os
+from typing import Iterator, List, Optional, Tuple
+
+from pipeline.result_cache import CACHED_DIR
+
+FINGERPRINT_FILE = 'fingerprints.csv'
+PARTITION_COLUMNS = ['test_case', 'webserver', 'scanner', 'iteration']
+# The results of a remote scan that came from the result cache
+CACHED_ITERATION = -1
+DICTIONARY_COLUMNS = ['fingerprint', 'fingerprint_raw', 'fingerprint_protocols', 'fingerprint_ciphers',
+                      'fingerprint_extensions', 'fingerprint_other']
+
+
+def _pyarrow():
+    """pyarrow is only needed for the fingerprint store, so it is an optional dependency"""
+    try:
+        import pyarrow
+        import pyarrow.compute
+        import pyarrow.csv
+        import pyarrow.dataset
+    except ImportError as e:
+        raise ImportError('The fingerprint store needs pyarrow, install it with "pip install pyarrow"') from e
+    return pyarrow
+
+
+def find_fingerprint_files(output_dir: str) -> Iterator[Tuple[dict, str]]:
+    """fingerprints.csv files of a local scan (<test case>/<webserver>/<scanner>/iteration=N) or a remote scan
+    (<scanner>/iteration=N) with their partition values, test case and webserver of a remote scan are null and
+    iteration=cached is iteration -1"""
+    for dirpath, dirnames, filenames in os.walk(output_dir):
+        dirnames.sort()
+        if FINGERPRINT_FILE not in filenames:
+            continue
+        parts = os.path.relpath(dirpath, output_dir).split(os.sep)
+        if len(parts) not in [2, 4] or not parts[-1].startswith('iteration='):
+            continue
+        if parts[-1] == CACHED_DIR:
+            iteration = CACHED_ITERATION
+        else:
+            try:
+                iteration = int(parts[-1][len('iteration='):])
+            except ValueError:
+                continue
+        test_case, webserver = (parts[0], parts[1]) if len(parts) == 4 else (None, None)
+        partition = {'test_case': test_case, 'webserver': webserver, 'scanner': parts[-2], 'iteration': iteration}
+        yield partition, os.path.join(dirpath, FINGERPRINT_FILE)
+
+
+def read_fingerprints(partition: dict, fp_file: str):
+    """One fingerprints.csv as an Arrow table with the partition columns and dictionary encoded fingerprints"""
+    pa = _pyarrow()
+    column_types = {'ip': pa.string(), 'port': pa.int32(), 'server_name': pa.string(),
+                    **{column: pa.string() for column in DICTIONARY_COLUMNS}}
+    table = pa.csv.read_csv(fp_file, convert_options=pa.csv.ConvertOptions(column_types=column_types))
+    for column in DICTIONARY_COLUMNS:
+        if column in table.column_names:
+            i = table.column_names.index(column)
+            table = table.set_column(i, column, table.column(column).dictionary_encode())
+    for column in PARTITION_COLUMNS:
+        value_type = pa.int32() if column == 'iteration' else pa.string()
+        table = table.append_column(column, pa.array([partition[column]] * table.num_rows, type=value_type))
+    return table
+
+
+def build_store(output_dir: str, store_dir: str, scanners: Optional[List[str]] = None) -> int:
+    """Write all fingerprints.csv below output_dir as Parquet dataset partitioned by test case, webserver, scanner,
+    and iteration and return the number of rows. Partitions that are written again replace the old ones."""
+    pa = _pyarrow()
+    rows = 0
+    for partition, fp_file in find_fingerprint_files(output_dir):
+        if scanners is not None and partition['scanner'] not in scanners:
+            continue
+        try:
+            table = read_fingerprints(partition, fp_file)
+        except pa.ArrowInvalid as e:
+            logging.error(f'Could not read {fp_file}', exc_info=e)
+            continue
+        pa.dataset.write_dataset(table, store_dir, format='parquet', partitioning=PARTITION_COLUMNS,
+                                 partitioning_flavor='hive', existing_data_behavior='delete_matching')
+        rows += table.num_rows
+    return rows
+
+
+def open_store(store_dir: str):
+    pa = _pyarrow()
+    schema = pa.schema([('test_case', pa.string()), ('webserver', pa.string()), ('scanner', pa.string()),
+                        ('iteration', pa.int32())])
+    return pa.dataset.dataset(store_dir, format='parquet', partitioning=pa.dataset.partitioning(schema, flavor='hive'))
+
+
+def _filter(scanner: Optional[str], test_case: Optional[str]):
+    pc = _pyarrow().compute
+    expression = pc.field('fingerprint').is_valid()
+    if scanner is not None:
+        expression &= pc.field('scanner') == scanner
+    if test_case is not None:
+        expression &= pc.field('test_case') == test_case
+    return expression
+
+
+def fingerprint_groups(store_dir: str, scanner: Optional[str] = None, test_case: Optional[str] = None):
+    """Servers per fingerprint and scanner (and test case and webserver), largest groups first"""
+    table = open_store(store_dir).to_table(columns=['test_case', 'webserver', 'scanner', 'fingerprint'],
+                                           filter=_filter(scanner, test_case))
+    table = table.set_column(3, 'fingerprint', table.column('fingerprint').cast(_pyarrow().string()))
+    groups = table.group_by(['scanner', 'test_case', 'webserver', 'fingerprint']).aggregate([('fingerprint', 'count')])
+    groups = groups.select(['scanner', 'test_case', 'webserver', 'fingerprint', 'fingerprint_count'])
+    groups = groups.rename_columns(['scanner', 'test_case', 'webserver', 'fingerprint', 'servers'])
+    return groups.sort_by([('scanner', 'ascending'), ('servers', 'descending')])
+
+
+def read_configs(output_dir: str, test_cases: Optional[List[str]] = None):
+    """configs.csv of all test cases, the config is identified by test case and config index"""
+    pa = _pyarrow()
+    tables = []
+    for name in sorted(os.listdir(output_dir)):
+        configs_file = os.path.join(output_dir, name, 'configs.csv')
+        if (test_cases is not None and name not in test_cases) or not os.path.isfile(configs_file):
+            continue
+        column_types = {'config_index': pa.int32(), 'config_hash': pa.string(), 'test_case': pa.string(),
+                        'iteration': pa.int32(), 'port': pa.int32()}
+        table = pa.csv.read_csv(configs_file, convert_options=pa.csv.ConvertOptions(column_types=column_types))
+        # test_case is where the config was scanned, which can be an earlier test case for duplicate configs
+        tables.append(table.append_column('config_test_case', pa.array([name] * table.num_rows, type=pa.string())))
+    if len(tables) == 0:
+        raise FileNotFoundError(f'No configs.csv below {output_dir}')
+    return pa.concat_tables(tables)
+
+
+def distinguishing_power(store_dir: str, output_dir: str, scanner: Optional[str] = None):
+    """Distinct fingerprints per distinct config (by effective parameters) of each scanner, test case, and webserver.
+
+    1.0 means that a scanner tells every config of a test case apart, configs that were not scanned successfully
+    by a scanner count as not distinguished. Values above 1.0 mean that equivalent configs got different fingerprints.
+    """
+    pa = _pyarrow()
+    pc = pa.compute
+    configs = read_configs(output_dir)
+    fingerprints = open_store(store_dir).to_table(
+        columns=['test_case', 'webserver', 'scanner', 'iteration', 'port', 'fingerprint'],
+        filter=_filter(scanner, None) & pc.field('test_case').is_valid())
+    fingerprints = fingerprints.set_column(5, 'fingerprint', fingerprints.column('fingerprint').cast(pa.string()))
+    joined = configs.join(fingerprints, keys=['test_case', 'iteration', 'port'], join_type='inner')
+    counts = joined.group_by(['scanner', 'config_test_case', 'webserver']).aggregate(
+        [('fingerprint', 'count_distinct')])
+    total = configs.group_by(['config_test_case']).aggregate([('config_hash', 'count_distinct')])
+    result = counts.join(total, keys=['config_test_case'])
+    power = pc.divide(pc.cast(result.column('fingerprint_count_distinct'), pa.float64()),
+                      pc.cast(result.column('config_hash_count_distinct'), pa.float64()))
+    result = pa.table({
+        'scanner': result.column('scanner'),
+        'test_case': result.column('config_test_case'),
+        'webserver': result.column('webserver'),
+        'configs': result.column('config_hash_count_distinct'),
+        'fingerprints': result.column('fingerprint_count_distinct'),
+        'distinguishing_power': power,
+    })
+    return result.sort_by([('test_case', 'ascending'), ('webserver', 'ascending'), ('scanner', 'ascending')])
@@ -0,0 +1,77 @@
+import hashlib
+import json
+import logging
+import os
+import time
+from pathlib import Path
+from typing import Dict, List, Optional
+
+JOURNAL_FILE = 'journal.jsonl'
+
+
+def output_files(path: Optional[str]) -> List[str]:
+    if path is None or not os.path.exists(path):
+        return []
+    if os.path.isfile(path):
+        return [path]
+    return sorted(os.path.join(dirpath, name) for dirpath, _, names in os.walk(path) for name in names)
+
+
+def files_checksum(base_dir: str, files: List[str]) -> Optional[str]:
+    """SHA-256 over the relative paths and contents of the files, None if one of them is missing"""
+    h = hashlib.sha256()
+    for name in files:
+        path = os.path.join(base_dir, name)
+        if not os.path.isfile(path):
+            return None
+        h.update(name.encode() + b'\0')
+        with open(path, mode='rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                h.update(block)
+        h.update(b'\0')
+    return h.hexdigest()
+
+
+class RunJournal(object):
+    """Append-only record of the completed units of a run and the checksum of the files they wrote.
+
+    A unit counts as completed as long as the files it wrote are unchanged, files that were added to its output
+    later on (e.g., fingerprints.csv) are ignored. Without resume an existing journal is started over.
+    """
+
+    def __init__(self, output_dir: str, resume: bool):
+        self.base_dir = output_dir
+        self.path = Path(output_dir, JOURNAL_FILE)
+        self.completed: Dict[str, dict] = dict()
+        if resume and self.path.exists():
+            with self.path.open() as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        # The last line of an interrupted run might be incomplete
+                        continue
+                    self.completed[entry['unit']] = entry
+        else:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            self.path.write_text('')
+
+    def is_done(self, unit: str) -> bool:
+        entry = self.completed.get(unit)
+        if entry is None:
+            return False
+        if files_checksum(self.base_dir, entry['files']) != entry['checksum']:
+            logging.warning(f'Output of {unit} changed since it completed, running it again')
+            del self.completed[unit]
+            return False
+        return True
+
+    def record(self, unit: str, output: Optional[str]):
+        files = [os.path.relpath(f, self.base_dir) for f in output_files(output)]
+        entry = {'unit': unit, 'checksum': files_checksum(self.base_dir, files), 'files': files,
+                 'completed': time.time()}
+        self.completed[unit] = entry
+        with self.path.open(mode='a') as f:
+            f.write(json.dumps(entry) + os.linesep)
+            f.flush()
+            os.fsync(f.fileno())
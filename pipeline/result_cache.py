@@ -0,0 +1,149 @@
+import csv
+import glob
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import time
+from pathlib import Path
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+CACHED_DIR = 'iteration=cached'
+# Goscanner writes an all zero JARM fingerprint if the handshakes failed
+EMPTY_JARM = '0' * 62
+
+Target = Tuple[str, str, str]
+
+
+def config_hash(*parts: str) -> str:
+    """Hash of everything that changes the result of a scanner, e.g., its flags and the fingerprint format"""
+    h = hashlib.sha256()
+    for part in parts:
+        h.update(part.encode() + b'\0')
+    return h.hexdigest()
+
+
+def parse_target(row: List[str]) -> Target:
+    """ip, port, and SNI ('' without) of a row of an input file (ip[:port][,server_name])"""
+    address = row[0].strip()
+    sni = row[1].strip() if len(row) > 1 else ''
+    if address.startswith('['):
+        ip, _, port = address[1:].partition(']')
+        port = port.lstrip(':')
+    elif address.count(':') > 1:
+        ip, port = address, ''
+    else:
+        ip, _, port = address.partition(':')
+    return ip, port or '443', sni
+
+
+def _read_csv(path: str) -> List[dict]:
+    with open(path, newline='') as f:
+        return list(csv.DictReader(f))
+
+
+def read_jarm_probes(jarm_dir: str) -> Dict[Target, str]:
+    """JARM fingerprints of a goscanner JARM scan by target.
+
+    The hosts.csv of the scan is joined on id with the first other file that has a column containing "jarm". Targets
+    without a usable JARM fingerprint are missing.
+    """
+    hosts_file = os.path.join(jarm_dir, 'hosts.csv')
+    if not os.path.exists(hosts_file):
+        logging.warning(f'No hosts.csv in {jarm_dir}, all targets are scanned')
+        return dict()
+    jarm_by_id = dict()
+    for path in sorted(glob.glob(os.path.join(jarm_dir, '*.csv'))):
+        if path == hosts_file:
+            continue
+        rows = _read_csv(path)
+        columns = [c for c in (rows[0].keys() if len(rows) > 0 else []) if c is not None and 'jarm' in c.lower()]
+        if len(columns) > 0 and 'id' in rows[0]:
+            jarm_by_id = {r['id']: r[columns[0]] for r in rows}
+            break
+    probes = dict()
+    for host in _read_csv(hosts_file):
+        jarm = jarm_by_id.get(host.get('id'), '')
+        if jarm in ['', EMPTY_JARM] or not host.get('ip'):
+            continue
+        target = (host['ip'].strip('[]'), host.get('port') or '443', host.get('server_name') or '')
+        probes[target] = jarm
+    return probes
+
+
+class ResultCache(object):
+    """Fingerprint rows by scanner, scanner config, and target in a sqlite database, together with the pre-probe
+    (JARM) fingerprint of the target at the time of the scan. Entries older than ttl seconds are evicted."""
+
+    def __init__(self, path: str, ttl: float):
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self.ttl = ttl
+        self.db = sqlite3.connect(path, timeout=60)
+        self.db.execute('CREATE TABLE IF NOT EXISTS results (scanner TEXT, config_hash TEXT, ip TEXT, port TEXT, '
+                        'sni TEXT, probe TEXT, row TEXT, scanned REAL, PRIMARY KEY (scanner, config_hash, ip, port, sni))')
+        with self.db:
+            evicted = self.db.execute('DELETE FROM results WHERE scanned < ?', (time.time() - ttl,)).rowcount
+        if evicted > 0:
+            logging.info(f'Evicted {evicted} expired results from {path}')
+
+    def lookup(self, scanner: str, config: str, target: Target, probe: Optional[str]) -> Optional[dict]:
+        """The cached row if the target was scanned within the TTL and its probe did not change since then"""
+        if probe is None:
+            return None
+        entry = self.db.execute('SELECT probe, row FROM results WHERE scanner = ? AND config_hash = ? AND ip = ? AND '
+                                'port = ? AND sni = ? AND scanned >= ?',
+                                (scanner, config, *target, time.time() - self.ttl)).fetchone()
+        if entry is None or entry[0] != probe:
+            return None
+        return json.loads(entry[1])
+
+    def store(self, scanner: str, config: str, entries: Iterable[Tuple[Target, str, dict]]):
+        now = time.time()
+        with self.db:
+            self.db.executemany('INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                                ((scanner, config, *target, probe, json.dumps(row), now)
+                                 for target, probe, row in entries))
+
+    def close(self):
+        self.db.close()
+
+
+def scan_with_cache(cache: ResultCache, scanner: str, config: str, server_name: Callable[[str, str], str],
+                    probes: Dict[Target, str], input_file: str, output_dir: str, scan: Callable[[List[str]], None]):
+    """Scan only the targets of input_file whose result is not cached, then cache the new results and write the
+    cached ones to iteration=cached/fingerprints.csv in output_dir.
+
+    server_name maps ip and SNI of a target to the server_name column of its row in fingerprints.csv.
+    """
+    with Path(input_file).open() as f:
+        lines = [line if line.endswith('\n') else line + '\n' for line in f if line.strip() != '']
+    hits = []
+    misses = []
+    expected: Dict[Tuple[str, str, str], Target] = dict()
+    for line in lines:
+        target = parse_target(next(csv.reader([line])))
+        row = cache.lookup(scanner, config, target, probes.get(target))
+        if row is None:
+            misses.append(line)
+            expected[(target[0], target[1], server_name(target[0], target[2]))] = target
+        else:
+            hits.append(row)
+    logging.info(f'{scanner}: {len(hits)} of {len(lines)} targets are cached')
+
+    scan(misses)
+
+    new_entries = []
+    for fp_file in glob.glob(os.path.join(output_dir, 'iteration=*', 'fingerprints.csv')):
+        for row in _read_csv(fp_file):
+            target = expected.get((row.get('ip', '').strip('[]'), str(row.get('port')), row.get('server_name')))
+            if target is not None and target in probes:
+                new_entries.append((target, probes[target], row))
+    cache.store(scanner, config, new_entries)
+
+    if len(hits) > 0:
+        Path(output_dir, CACHED_DIR).mkdir(parents=True, exist_ok=True)
+        with Path(output_dir, CACHED_DIR, 'fingerprints.csv').open(mode='w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=list(hits[0]), extrasaction='ignore')
+            writer.writeheader()
+            writer.writerows(hits)
@@ -0,0 +1,138 @@
+import logging
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, Future, wait, FIRST_COMPLETED
+from dataclasses import dataclass, field
+from typing import Callable, Dict, List, Optional, Set
+
+import pipeline.telemetry as telemetry
+from pipeline.journal import RunJournal
+
+
+@dataclass
+class Step:
+    name: str
+    func: Callable
+    args: tuple = ()
+    deps: List[str] = field(default_factory=list)
+    # Exclusive resources, e.g., the port set of a Client Hello capture or an output directory
+    resources: Set[str] = field(default_factory=set)
+    # CPU bound post-processing runs in the process pool and does not count against max_parallel
+    post_process: bool = False
+    # File or directory the step writes, recorded in the journal to detect changed results on resume
+    output: Optional[str] = None
+
+
+class PhaseScheduler(object):
+    """Runs a dependency graph of scan and post-processing steps.
+
+    Steps start in the order they were added as soon as their dependencies are done and none of their resources
+    is held by a running step. With max_parallel=1 the scans run one after another as before.
+    With a journal, every step is a unit named unit_prefix + step name, completed units are skipped.
+    """
+
+    def __init__(self, max_parallel: int = 1, processes: Optional[int] = None, journal: Optional[RunJournal] = None,
+                 unit_prefix: str = ''):
+        self.max_parallel = max_parallel
+        self.processes = processes
+        self.journal = journal
+        self.unit_prefix = unit_prefix
+        self.steps: Dict[str, Step] = dict()
+
+    def add(self, name: str, func: Callable, *args, deps: List[str] = (), resources: Set[str] = (),
+            post_process: bool = False, output: Optional[str] = None) -> str:
+        if name in self.steps:
+            raise ValueError(f'Step {name} already exists')
+        for dep in deps:
+            if dep not in self.steps:
+                raise ValueError(f'Unknown dependency {dep} of {name}')
+        self.steps[name] = Step(name, func, args, list(deps), set(resources), post_process, output)
+        return name
+
+    def unit(self, step: Step) -> str:
+        return f'{self.unit_prefix}{step.name}'
+
+    def completed(self) -> Set[str]:
+        """Steps that are done according to the journal, a step whose dependencies run again runs again as well"""
+        completed = set()
+        if self.journal is None:
+            return completed
+        # Dependencies are always added before the steps that need them
+        for name, step in self.steps.items():
+            if all(d in completed for d in step.deps) and self.journal.is_done(self.unit(step)):
+                completed.add(name)
+        return completed
+
+    def _startable(self, done: Set[str], running: Dict[str, Step]) -> List[Step]:
+        held = set().union(*(s.resources for s in running.values()))
+        scans = sum(1 for s in running.values() if not s.post_process)
+        startable = []
+        for step in self.steps.values():
+            if step.name in done or step.name in running or not all(d in done for d in step.deps):
+                continue
+            if step.resources & held:
+                continue
+            if not step.post_process:
+                if scans >= self.max_parallel:
+                    continue
+                scans += 1
+            held |= step.resources
+            startable.append(step)
+        return startable
+
+    def schedule(self) -> List[List[str]]:
+        """The waves of steps that run together, assuming every step takes the same time"""
+        done = self.completed()
+        waves = []
+        while len(done) < len(self.steps):
+            wave = self._startable(done, dict())
+            if len(wave) == 0:
+                raise ValueError(f'Steps {set(self.steps) - done} can never run')
+            waves.append([s.name for s in wave])
+            done.update(waves[-1])
+        return waves
+
+    def format_schedule(self) -> str:
+        lines = []
+        for i, wave in enumerate(self.schedule()):
+            lines.append(f'Wave {i}:')
+            for name in wave:
+                step = self.steps[name]
+                kind = 'post' if step.post_process else 'scan'
+                deps = f' after {", ".join(step.deps)}' if len(step.deps) > 0 else ''
+                lines.append(f'  [{kind}] {name}{deps}')
+        return '\n'.join(lines)
+
+    def run(self):
+        """Run all steps, after the first failure no new steps are started and the error is raised at the end"""
+        done: Set[str] = self.completed()
+        for name in done:
+            logging.info(f'Skipping {self.unit(self.steps[name])}, it is already completed')
+        running: Dict[str, Step] = dict()
+        futures: Dict[Future, Step] = dict()
+        error: Optional[BaseException] = None
+        with ThreadPoolExecutor(max(self.max_parallel, 1)) as threads, ProcessPoolExecutor(self.processes) as processes:
+            while True:
+                if error is None:
+                    for step in self._startable(done, running):
+                        executor = processes if step.post_process else threads
+                        logging.info(f'Starting {step.name}')
+                        futures[executor.submit(telemetry.traced, step.name, step.output, {'unit': self.unit(step)},
+                                                step.func, *step.args)] = step
+                        running[step.name] = step
+                if len(futures) == 0:
+                    break
+                finished, _ = wait(futures, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    step = futures.pop(future)
+                    del running[step.name]
+                    e = future.exception()
+                    if e is not None:
+                        logging.error(f'Step {step.name} failed', exc_info=e)
+                        error = error or e
+                    else:
+                        done.add(step.name)
+                        if self.journal is not None:
+                            self.journal.record(self.unit(step), step.output)
+        if error is not None:
+            raise error
+        if len(done) < len(self.steps):
+            raise ValueError(f'Steps {set(self.steps) - done} can never run')
@@ -0,0 +1,116 @@
+import logging
+import os
+import shutil
+import subprocess
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, Future, wait, FIRST_COMPLETED
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Tuple
+
+import pipeline.telemetry as telemetry
+
+
+class ShardedExecutor(object):
+    """Scans targets in shards that run in parallel, each shard gets its own iteration=N directory.
+
+    The shard size follows the observed scan time per target so that a shard takes about target_seconds. If a shard
+    times out, its output is dropped and its targets are re-queued as two halves, a single target that times out
+    is written to failed.csv.
+    """
+
+    def __init__(self, scan: Callable[[str, str, float], None], post_process: Optional[Callable[[str], object]],
+                 output_dir: str, parallel: int = 4, initial_size: int = 200, min_size: int = 1,
+                 max_size: int = 1000, timeout: float = 7200, target_seconds: Optional[float] = None,
+                 processes: Optional[int] = None):
+        self.scan = scan
+        self.post_process = post_process
+        self.output_dir = output_dir
+        self.parallel = parallel
+        self.min_size = min_size
+        self.max_size = max_size
+        self.timeout = timeout
+        self.target_seconds = target_seconds if target_seconds is not None else timeout / 4
+        self.processes = processes
+        self.size = initial_size
+        self.seconds_per_target: Optional[float] = None
+        self.iteration = 0
+        # Name of the spans in the trace
+        self.name = os.path.basename(os.path.normpath(output_dir))
+
+    def _observe(self, targets: int, duration: float):
+        latency = duration / targets
+        if self.seconds_per_target is None:
+            self.seconds_per_target = latency
+        else:
+            self.seconds_per_target = 0.7 * self.seconds_per_target + 0.3 * latency
+        size = int(self.target_seconds / max(self.seconds_per_target, 1e-3))
+        self.size = max(self.min_size, min(self.max_size, size))
+
+    def _write_input(self, shard: List[str]) -> Tuple[str, str]:
+        shard_dir = os.path.join(self.output_dir, f'iteration={self.iteration}')
+        shard_input = os.path.join(self.output_dir, f'iteration-{self.iteration}-input.csv')
+        self.iteration += 1
+        Path(self.output_dir).mkdir(parents=True, exist_ok=True)
+        with Path(shard_input).open(mode='w') as f:
+            f.writelines(shard)
+        return shard_input, shard_dir
+
+    def _scan(self, shard_input: str, shard_dir: str, targets: int) -> float:
+        start = time.monotonic()
+        with telemetry.span(f'{self.name}-shard', shard_dir, unit=shard_dir, targets=targets):
+            self.scan(shard_input, shard_dir, self.timeout)
+        return time.monotonic() - start
+
+    def run(self, targets: List[str]):
+        """Scan all targets (lines of the input file), errors other than timeouts are raised once all shards ended"""
+        pending = deque([[t if t.endswith('\n') else t + '\n' for t in targets if t.strip() != '']])
+        running: Dict[Future, Tuple[List[str], str]] = dict()
+        post_jobs: List[Future] = []
+        failed: List[str] = []
+        error: Optional[BaseException] = None
+        with ThreadPoolExecutor(self.parallel) as threads, ProcessPoolExecutor(self.processes) as processes:
+            while True:
+                while error is None and len(running) < self.parallel and len(pending) > 0:
+                    group = pending[0]
+                    shard, pending[0] = group[:self.size], group[self.size:]
+                    if len(pending[0]) == 0:
+                        pending.popleft()
+                    if len(shard) == 0:
+                        continue
+                    shard_input, shard_dir = self._write_input(shard)
+                    logging.info(f'Scanning {len(shard)} targets in {shard_dir}')
+                    running[threads.submit(self._scan, shard_input, shard_dir, len(shard))] = shard, shard_dir
+                if len(running) == 0:
+                    break
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    shard, shard_dir = running.pop(future)
+                    e = future.exception()
+                    if isinstance(e, subprocess.TimeoutExpired):
+                        shutil.rmtree(shard_dir, ignore_errors=True)
+                        self._observe(len(shard), self.timeout)
+                        if len(shard) > 1:
+                            logging.warning(f'{shard_dir} timed out, re-queueing its {len(shard)} targets')
+                            # Smaller shards isolate the slow targets, the re-queued ones are not merged again
+                            half = len(shard) // 2
+                            pending.extendleft([shard[half:], shard[:half]])
+                        else:
+                            logging.error(f'{shard[0].strip()} timed out in {shard_dir}')
+                            failed.extend(shard)
+                    elif e is not None:
+                        logging.error(f'Scanning {shard_dir} failed', exc_info=e)
+                        error = error or e
+                    else:
+                        self._observe(len(shard), future.result())
+                        if self.post_process is not None:
+                            post_jobs.append(processes.submit(telemetry.traced, f'{self.name}-shard-post', None,
+                                                              {'unit': shard_dir}, self.post_process, shard_dir))
+            for job in post_jobs:
+                job.result()
+
+        if len(failed) > 0:
+            with Path(self.output_dir, 'failed.csv').open(mode='a') as f:
+                f.writelines(failed)
+        if error is not None:
+            raise error
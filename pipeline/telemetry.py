@@ -0,0 +1,185 @@
+import json
+import logging
+import os
+import resource
+import subprocess
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Callable, Iterator, List, Optional
+
+from pipeline.journal import output_files
+
+TRACE_FILE = 'trace.jsonl'
+# Worker processes find the trace of the run through the environment
+TRACE_ENV = 'DISSECTLS_TRACE'
+RUN_ENV = 'DISSECTLS_RUN'
+
+RUSAGE_THREAD = getattr(resource, 'RUSAGE_THREAD', resource.RUSAGE_SELF)
+
+_local = threading.local()
+
+
+def start(output_dir: str) -> str:
+    """Trace the spans of this process and its workers to trace.jsonl in output_dir and return the id of the run"""
+    os.makedirs(output_dir, exist_ok=True)
+    run = uuid.uuid4().hex
+    os.environ[TRACE_ENV] = os.path.abspath(os.path.join(output_dir, TRACE_FILE))
+    os.environ[RUN_ENV] = run
+    return run
+
+
+def emit(record: dict):
+    path = os.environ.get(TRACE_ENV)
+    if path is None:
+        return
+    line = json.dumps({'run': os.environ.get(RUN_ENV), **record}) + os.linesep
+    # A single write to a file opened for appending, so that threads and worker processes do not mix their lines
+    fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(fd, line.encode())
+    finally:
+        os.close(fd)
+
+
+class Span(object):
+    """Wall time, own CPU time, and the resources of the child processes that were waited for during a phase"""
+
+    def __init__(self, phase: str, output: Optional[str], attributes: dict):
+        self.record = OrderedDict(phase=phase, start=time.time(), wall=0.0, cpu_user=0.0, cpu_sys=0.0,
+                                  children=0, child_cpu_user=0.0, child_cpu_sys=0.0, child_max_rss_kib=0,
+                                  max_rss_kib=0, bytes_written=None, targets=None, chs=None, status='ok')
+        self.record.update(attributes)
+        self.output = output
+        self._start = time.monotonic()
+        self._usage = resource.getrusage(RUSAGE_THREAD)
+
+    def annotate(self, **attributes):
+        self.record.update(attributes)
+
+    def add_child(self, rusage: resource.struct_rusage):
+        self.record['children'] += 1
+        self.record['child_cpu_user'] += rusage.ru_utime
+        self.record['child_cpu_sys'] += rusage.ru_stime
+        self.record['child_max_rss_kib'] = max(self.record['child_max_rss_kib'], rusage.ru_maxrss)
+
+    def finish(self, error: Optional[BaseException]):
+        usage = resource.getrusage(RUSAGE_THREAD)
+        self.record['wall'] = time.monotonic() - self._start
+        self.record['cpu_user'] = usage.ru_utime - self._usage.ru_utime
+        self.record['cpu_sys'] = usage.ru_stime - self._usage.ru_stime
+        self.record['max_rss_kib'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        if self.output is not None:
+            # The phases start with an empty output, so its size is what they wrote
+            self.record['bytes_written'] = sum(os.path.getsize(f) for f in output_files(self.output))
+        if error is not None:
+            self.record['status'] = type(error).__name__
+        emit(self.record)
+
+
+def current() -> Optional[Span]:
+    stack = getattr(_local, 'spans', None)
+    return stack[-1] if stack else None
+
+
+def annotate(**attributes):
+    span = current()
+    if span is not None:
+        span.annotate(**attributes)
+
+
+@contextmanager
+def span(phase: str, output: Optional[str] = None, **attributes) -> Iterator[Span]:
+    """Measure a phase of the current thread, child processes reaped with wait4 count towards it"""
+    s = Span(phase, output, attributes)
+    if not hasattr(_local, 'spans'):
+        _local.spans = []
+    _local.spans.append(s)
+    error = None
+    try:
+        yield s
+    except BaseException as e:
+        error = e
+        raise
+    finally:
+        _local.spans.pop()
+        s.finish(error)
+
+
+def traced(phase: str, output: Optional[str], attributes: dict, func: Callable, *args):
+    """Run func in a span, an int result is the number of targets (e.g., of the fingerprint generation)"""
+    with span(phase, output, **attributes) as s:
+        result = func(*args)
+        if isinstance(result, int) and not isinstance(result, bool):
+            s.annotate(targets=result)
+        return result
+
+
+def emit_process(phase: str, wall: float, rusage: resource.struct_rusage, **attributes):
+    """Record a process that ran alongside a span, e.g., tcpdump, on its own"""
+    s = Span(phase, None, attributes)
+    s.add_child(rusage)
+    s.record['wall'] = wall
+    emit(s.record)
+
+
+def wait4(process: subprocess.Popen, timeout: Optional[float] = None, record: bool = True) -> resource.struct_rusage:
+    """Wait for process like Popen.wait, but also return the resources it used and add them to the current span"""
+    deadline = None if timeout is None else time.monotonic() + timeout
+    delay = 0.001
+    while True:
+        pid, status, rusage = os.wait4(process.pid, os.WNOHANG if deadline is not None else 0)
+        if pid != 0:
+            break
+        if time.monotonic() >= deadline:
+            raise subprocess.TimeoutExpired(process.args, timeout)
+        time.sleep(delay)
+        delay = min(delay * 2, 0.1)
+    process.returncode = os.waitstatus_to_exitcode(status)
+    s = current()
+    if s is not None and record:
+        s.add_child(rusage)
+    return rusage
+
+
+def read_trace(output_dir: str, run: Optional[str] = None) -> List[dict]:
+    records = []
+    path = os.path.join(output_dir, TRACE_FILE)
+    if not os.path.exists(path):
+        return records
+    with open(path) as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                logging.warning(f'Skipping a broken line of {path}')
+                continue
+            if run is None or record.get('run') == run:
+                records.append(record)
+    return records
+
+
+def summary(records: List[dict]) -> str:
+    """Table of the spans per phase, sorted by their total wall time"""
+    phases = OrderedDict()
+    for r in records:
+        p = phases.setdefault(r['phase'], {'count': 0, 'failed': 0, 'wall': 0.0, 'cpu': 0.0, 'child_cpu': 0.0,
+                                           'child_max_rss_kib': 0, 'bytes_written': 0, 'targets': 0, 'chs': 0})
+        p['count'] += 1
+        p['failed'] += r['status'] != 'ok'
+        p['wall'] += r['wall']
+        p['cpu'] += r['cpu_user'] + r['cpu_sys']
+        p['child_cpu'] += r['child_cpu_user'] + r['child_cpu_sys']
+        p['child_max_rss_kib'] = max(p['child_max_rss_kib'], r['child_max_rss_kib'])
+        for key in ['bytes_written', 'targets', 'chs']:
+            p[key] += r.get(key) or 0
+    lines = [f'{"phase":<24} {"count":>5} {"failed":>6} {"wall [s]":>9} {"cpu [s]":>8} {"child cpu [s]":>13} '
+             f'{"child RSS [MiB]":>15} {"written [MiB]":>13} {"targets":>8} {"targets/s":>9} {"CHs":>8}']
+    for name, p in sorted(phases.items(), key=lambda item: -item[1]['wall']):
+        rate = p['targets'] / p['wall'] if p['wall'] > 0 else 0.0
+        lines.append(f'{name:<24} {p["count"]:>5} {p["failed"]:>6} {p["wall"]:>9.1f} {p["cpu"]:>8.1f} '
+                     f'{p["child_cpu"]:>13.1f} {p["child_max_rss_kib"] / 1024:>15.1f} '
+                     f'{p["bytes_written"] / (1 << 20):>13.1f} {p["targets"]:>8} {rate:>9.1f} {p["chs"]:>8}')
+    return '\n'.join(lines)
@@ -1,7 +1,11 @@
 from functools import reduce
+from typing import List, Tuple
 
 from docker import TLSConfig
 
+SSL_STAPLING_CACHE = 'SSLStaplingCache "shmcb:/usr/local/apache2/logs/ssl_stapling(32768)"\nSSLStaplingStandardCacheTimeout 3600'
+SSL_SESSION_CACHE = 'SSLSessionCache        "shmcb:/usr/local/apache2/logs/ssl_scache(512000)"\nSSLSessionCacheTimeout  300'
+
 
 def create_apache_config(config: TLSConfig):
     ssl_certificate = "/etc/certificates/cert.pem"
@@ -12,7 +16,7 @@ def create_apache_config(config: TLSConfig):
     ssl_prefer_server_ciphers = 'on' if config.ssl_prefer_server_ciphers else 'off'
     ssl_session_tickets = 'on' if config.ssl_session_tickets else 'off'
     ssl_stapling = 'on' if config.ssl_stapling else 'off'
-    ssl_stapling_cache = 'SSLStaplingCache "shmcb:/usr/local/apache2/logs/ssl_stapling(32768)"\nSSLStaplingStandardCacheTimeout 3600' if config.ssl_stapling else ''
+    ssl_stapling_cache = SSL_STAPLING_CACHE if config.ssl_stapling else ''
 
     ssl_ciphers = reduce(lambda x, y: f'{x}:{y}', config.ssl_ciphers)
 
@@ -41,6 +45,61 @@ SSLSessionTickets       {ssl_session_tickets}
 SSLUseStapling {ssl_stapling}
 {ssl_stapling_cache}
 
-SSLSessionCache        "shmcb:/usr/local/apache2/logs/ssl_scache(512000)"
-SSLSessionCacheTimeout  300
+{SSL_SESSION_CACHE}
+    """
+
+
+def pack_key(config: TLSConfig) -> tuple:
+    """Configs with the same key can share a container.
+
+    The TLS directives are set per VirtualHost, but the OCSP stapling cache is server-global, so configs with and
+    without stapling run in separate containers like they do on their own.
     """
+    return (config.ssl_stapling,)
+
+
+def create_apache_packed_config(configs: List[Tuple[TLSConfig, int]]) -> str:
+    """One VirtualHost per config, each listening on its own port, all configs need the same pack_key"""
+    listen = '\n'.join(f'Listen {port}' for _, port in configs)
+    virtual_hosts = ''.join(create_apache_virtual_host(config, port) for config, port in configs)
+    ssl_stapling_cache = SSL_STAPLING_CACHE if any(config.ssl_stapling for config, _ in configs) else ''
+    return f"""
+{listen}
+{virtual_hosts}
+{ssl_stapling_cache}
+
+{SSL_SESSION_CACHE}
+    """
+
+
+def create_apache_virtual_host(config: TLSConfig, port: int) -> str:
+    ssl_certificate = "/etc/certificates/cert.pem"
+    ssl_certificate_key = "/etc/certificates/key.pem"
+
+    ssl_protocols = ' '.join(map(lambda x: f'+{x}', config.ssl_protocols))
+    h2 = 'h2' if config.http2 else ''
+    ssl_prefer_server_ciphers = 'on' if config.ssl_prefer_server_ciphers else 'off'
+    ssl_session_tickets = 'on' if config.ssl_session_tickets else 'off'
+    ssl_stapling = 'on' if config.ssl_stapling else 'off'
+
+    ssl_ciphers = reduce(lambda x, y: f'{x}:{y}', config.ssl_ciphers)
+
+    return f"""
+<VirtualHost *:{port}>
+    SSLEngine on
+
+    SSLCertificateFile     {ssl_certificate}
+    SSLCertificateKeyFile   {ssl_certificate_key}
+
+    Protocols {h2} http/1.1
+
+    ServerName example.com:{port}
+
+    SSLProtocol             -all {ssl_protocols}
+    SSLCipherSuite          {ssl_ciphers}
+    SSLHonorCipherOrder      {ssl_prefer_server_ciphers}
+    SSLSessionTickets       {ssl_session_tickets}
+
+    SSLUseStapling {ssl_stapling}
+</VirtualHost>
+"""
@@ -1,7 +1,19 @@
+from typing import List, Tuple
+
 from docker import TLSConfig
 
 
-def create_nginx_config(config: TLSConfig):
+def pack_key(config: TLSConfig) -> tuple:
+    """Configs with the same key can share a container, nginx sets every TLS directive per server block"""
+    return ()
+
+
+def create_nginx_packed_config(configs: List[Tuple[TLSConfig, int]]) -> str:
+    """One server block per config, each listening on its own port"""
+    return ''.join(create_nginx_config(config, port) for config, port in configs)
+
+
+def create_nginx_config(config: TLSConfig, port: int = 443):
     ssl_certificate = "/etc/certificates/cert.pem"
     ssl_certificate_key = "/etc/certificates/key.pem"
 
@@ -14,8 +26,8 @@ def create_nginx_config(config: TLSConfig):
 
     return f"""
 server {{
-    listen 443 ssl {h2};
-    listen [::]:443 ssl {h2};
+    listen {port} ssl {h2};
+    listen [::]:{port} ssl {h2};
 
     ssl_certificate {ssl_certificate};
     ssl_certificate_key {ssl_certificate_key};
@@ -1,5 +1,12 @@
+import hashlib
+import json
 from itertools import chain, combinations, permutations
-from typing import List
+from math import comb, perm
+from typing import List, Callable, Iterator, Tuple
+
+PROTOCOL_ORDER = ['SSLv2', 'SSLv3', 'TLSv1', 'TLSv1.1', 'TLSv1.2', 'TLSv1.3']
+# OpenSSL cipher names that only TLS 1.2 can negotiate, TLS 1.3 cipher suites are not set with ssl_ciphers
+TLS12_ONLY_CIPHER_PARTS = ['GCM', 'CCM', 'SHA256', 'SHA384', 'CHACHA20']
 
 
 class TLSConfig:
@@ -15,55 +22,143 @@ class TLSConfig:
     # ssl_ciphers = ['ECDHE-ECDSA-AES128-GCM-SHA256', 'ECDHE-RSA-AES128-GCM-SHA256', 'ECDHE-ECDSA-AES256-GCM-SHA384', 'ECDHE-RSA-AES256-GCM-SHA384', 'ECDHE-ECDSA-CHACHA20-POLY1305', 'ECDHE-RSA-CHACHA20-POLY1305', 'DHE-RSA-AES128-GCM-SHA256', 'DHE-RSA-AES256-GCM-SHA384', 'DHE-RSA-CHACHA20-POLY1305', 'ECDHE-ECDSA-AES128-SHA256', 'ECDHE-RSA-AES128-SHA256', 'ECDHE-ECDSA-AES128-SHA', 'ECDHE-RSA-AES128-SHA', 'ECDHE-ECDSA-AES256-SHA384', 'ECDHE-RSA-AES256-SHA384', 'ECDHE-ECDSA-AES256-SHA', 'ECDHE-RSA-AES256-SHA', 'DHE-RSA-AES128-SHA256', 'DHE-RSA-AES256-SHA256', 'AES128-GCM-SHA256', 'AES256-GCM-SHA384', 'AES128-SHA256', 'AES256-SHA256', 'AES128-SHA', 'AES256-SHA', 'DES-CBC3-SHA']
 
 
-def generate_configs(test_case):
-    """Generator for all configs for a test case (currently not combining the different arguments from the test case)"""
-    if test_case.test_versions:
-        default_config = TLSConfig()
-        for versions in powerset(default_config.ssl_protocols):
-            if len(versions) > 0:
-                config = TLSConfig()
-                config.ssl_protocols = versions
-                yield config
-
-    if test_case.test_ciphers:
-        test_ciphers = ['ECDHE-RSA-AES256-GCM-SHA384', 'ECDHE-RSA-AES256-SHA384', 'ECDHE-RSA-CHACHA20-POLY1305', 'ECDHE-RSA-AES256-SHA', 'AES256-GCM-SHA384', 'AES256-SHA256']
-        for ciphers in powerperm(test_ciphers):
-            if len(ciphers) > 0:
-                config = TLSConfig()
-                config.ssl_protocols = config.ssl_protocols[:3]
-                config.ssl_ciphers = list(ciphers) + ['AES256-SHA']
-                yield config
-
-    if test_case.test_preference:
-        config = TLSConfig()
-        yield config
-        config = TLSConfig()
-        config.ssl_prefer_server_ciphers = False
-        yield config
+TEST_CIPHERS = ['ECDHE-RSA-AES256-GCM-SHA384', 'ECDHE-RSA-AES256-SHA384', 'ECDHE-RSA-CHACHA20-POLY1305', 'ECDHE-RSA-AES256-SHA', 'AES256-GCM-SHA384', 'AES256-SHA256']
 
-    if test_case.test_ocsp:
-        config = TLSConfig()
-        yield config
-        config = TLSConfig()
-        config.ssl_stapling = True
-        yield config
 
-    if test_case.test_session_ticket:
-        config = TLSConfig()
-        yield config
+def generate_configs(test_case):
+    """Generator for all configs for a test case (currently not combining the different arguments from the test case)"""
+    return iter(ConfigSpace(test_case))
+
+
+class ConfigSpace(object):
+    """All configs of a test case in the order of generate_configs, with random access to the k-th config.
+
+    Configs are built on access by unranking the combinations and permutations instead of iterating up to them.
+    """
+
+    def __init__(self, test_case):
+        self.sections: List[Tuple[int, Callable[[int], TLSConfig]]] = []
+        if test_case.test_versions:
+            n = len(TLSConfig.ssl_protocols)
+            self.sections.append((sum(comb(n, r) for r in range(1, n + 1)), self._versions))
+        if test_case.test_ciphers:
+            n = len(TEST_CIPHERS)
+            self.sections.append((sum(perm(n, r) for r in range(1, n + 1)), self._ciphers))
+        if test_case.test_preference:
+            self.sections.append((2, lambda k: _variant(k, 'ssl_prefer_server_ciphers', False)))
+        if test_case.test_ocsp:
+            self.sections.append((2, lambda k: _variant(k, 'ssl_stapling', True)))
+        if test_case.test_session_ticket:
+            self.sections.append((2, lambda k: _variant(k, 'ssl_session_tickets', True)))
+        if test_case.test_alpn:
+            self.sections.append((2, lambda k: _variant(k, 'http2', False)))
+        if test_case.test_nothing:
+            self.sections.append((1, lambda k: TLSConfig()))
+
+    def __len__(self):
+        return sum(size for size, _ in self.sections)
+
+    def __getitem__(self, k: int) -> TLSConfig:
+        if k < 0:
+            k += len(self)
+        if k < 0:
+            raise IndexError(k)
+        for size, config_at in self.sections:
+            if k < size:
+                return config_at(k)
+            k -= size
+        raise IndexError(k)
+
+    def __iter__(self) -> Iterator[TLSConfig]:
+        return (self[k] for k in range(len(self)))
+
+    @staticmethod
+    def _versions(k: int) -> TLSConfig:
         config = TLSConfig()
-        config.ssl_session_tickets = True
-        yield config
+        config.ssl_protocols = unrank_subset(TLSConfig.ssl_protocols, k + 1, comb)
+        return config
 
-    if test_case.test_alpn:
-        config = TLSConfig()
-        yield config
+    @staticmethod
+    def _ciphers(k: int) -> TLSConfig:
         config = TLSConfig()
-        config.http2 = False
-        yield config
-
-    if test_case.test_nothing:
-        yield TLSConfig()
+        config.ssl_protocols = config.ssl_protocols[:3]
+        config.ssl_ciphers = list(unrank_subset(TEST_CIPHERS, k + 1, perm)) + ['AES256-SHA']
+        return config
+
+
+def _variant(k: int, attribute: str, value) -> TLSConfig:
+    """The default config and the default config with one changed attribute"""
+    config = TLSConfig()
+    if k == 1:
+        setattr(config, attribute, value)
+    return config
+
+
+def unrank_subset(items: list, k: int, count: Callable[[int, int], int]) -> tuple:
+    """k-th element of powerset (count=comb) or powerperm (count=perm) of items"""
+    n = len(items)
+    r = 0
+    while k >= count(n, r):
+        k -= count(n, r)
+        r += 1
+    return unrank_combination(items, r, k) if count is comb else unrank_permutation(items, r, k)
+
+
+def unrank_combination(items: list, r: int, k: int) -> tuple:
+    """k-th r-combination of items in the order of itertools.combinations"""
+    result = []
+    start = 0
+    for j in range(r):
+        for c in range(start, len(items)):
+            block = comb(len(items) - c - 1, r - j - 1)
+            if k < block:
+                result.append(items[c])
+                start = c + 1
+                break
+            k -= block
+    return tuple(result)
+
+
+def unrank_permutation(items: list, r: int, k: int) -> tuple:
+    """k-th r-permutation of items in the order of itertools.permutations"""
+    pool = list(items)
+    result = []
+    for j in range(r):
+        block = perm(len(pool) - 1, r - j - 1)
+        result.append(pool.pop(k // block))
+        k %= block
+    return tuple(result)
+
+
+def effective_parameters(config: TLSConfig) -> dict:
+    """The TLS parameters that define how the server behaves, configs with equal parameters behave the same.
+
+    Ciphers that none of the enabled protocols can negotiate are dropped, and without server preference the order of
+    the ciphers does not matter.
+    """
+    protocols = sorted(set(config.ssl_protocols), key=PROTOCOL_ORDER.index)
+    pre_tls13 = [p for p in protocols if p != 'TLSv1.3']
+    ciphers = []
+    for cipher in config.ssl_ciphers:
+        if cipher in ciphers or len(pre_tls13) == 0:
+            continue
+        if 'TLSv1.2' not in pre_tls13 and any(part in cipher for part in TLS12_ONLY_CIPHER_PARTS):
+            continue
+        ciphers.append(cipher)
+    if not config.ssl_prefer_server_ciphers:
+        ciphers = sorted(ciphers)
+    return {
+        'ssl_protocols': protocols,
+        'ssl_ciphers': ciphers,
+        'ssl_prefer_server_ciphers': config.ssl_prefer_server_ciphers,
+        'ssl_stapling': config.ssl_stapling,
+        'ssl_session_tickets': config.ssl_session_tickets,
+        'http2': config.http2,
+    }
+
+
+def config_hash(config: TLSConfig) -> str:
+    return hashlib.sha256(json.dumps(effective_parameters(config), sort_keys=True).encode()).hexdigest()
 
 
 def powerperm(iterable):